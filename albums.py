@@ -0,0 +1,30 @@
+import asyncio
+
+from aiogram import BaseMiddleware
+
+
+class AlbumMiddleware(BaseMiddleware):
+    def __init__(self, latency=0.5):
+        self.latency = latency
+        self.coalesced = 0
+        self._albums = {}
+
+    async def __call__(self, handler, event, data):
+        if not event.media_group_id:
+            return await handler(event, data)
+
+        key = (event.chat.id, event.media_group_id)
+        album = self._albums.get(key)
+        if album is not None:
+            album.append(event)
+            self.coalesced += 1
+            return None
+
+        album = self._albums[key] = [event]
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            del self._albums[key]
+        album.sort(key=lambda message: message.message_id)
+        data['album'] = album
+        return await handler(album[0], data)
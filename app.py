@@ -1,24 +1,42 @@
 import os
-import random
-import string
+import json
+import logging
 import asyncio
-from aiogram import Bot, Dispatcher, types
+import signal
+import time
+from aiogram import Bot, Dispatcher, F, html, types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.enums import ParseMode
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.methods import CopyMessages
 from dotenv import load_dotenv
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 import db
-
-SUBJECTS = {
-    'russian': '📚 Русский язык',
-    'math': '📘 Математика',
-    'informatics': '🖥 Информатика',
-    'biology': '🍀 Биология',
-    'geography': '🌏 География'
-}
+import async_db
+from albums import AlbumMiddleware
+from broadcast import Broadcaster
+from cluster import run_worker
+from codes import CodeAllocator
+from fsm_storage import SqliteStorage
+from matching import MatchingEngine
+import metrics
+from sender import PRIORITY_NORMAL, PRIORITY_REPLY, SendQueue
+from sla import SlaScheduler
+from subjects import SUBJECTS
+from text_router import TextCommandRouter
+from throttling import ThrottlingMiddleware
+from ticket_queue import TicketQueue
+from webhook import run_webhook
+from write_batcher import WriteBatcher
+
+MAX_CODES_PER_REQUEST = 100
+TICKETS_PER_PAGE = 5
+SUGGEST_SIMILARITY = 0.5
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -27,14 +45,69 @@ ADMIN_CHAT_LINK = os.getenv("ADMIN_LIMK")
 if not BOT_TOKEN:
     raise ValueError("Токен не найден! Проверьте .env файл.")
 
+WORKER_NAME = os.getenv("WORKER_NAME") or None
+TELEGRAM_API = os.getenv("TELEGRAM_API")
+
 bot = Bot(
     token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API)) if TELEGRAM_API else None,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
-dp = Dispatcher()
+buttons = TextCommandRouter()
+code_allocator = CodeAllocator(
+    owner=os.getenv("CODE_POOL_OWNER", "main"),
+    batch_size=int(os.getenv("CODE_POOL_BATCH", "200"))
+)
+dp = Dispatcher(storage=SqliteStorage(
+    ttl=float(os.getenv("FSM_TTL", str(24 * 60 * 60))),
+    flush_interval=float(os.getenv("FSM_FLUSH_INTERVAL", "0.05")),
+    max_hot=int(os.getenv("FSM_MAX_HOT", "10000"))
+))
+write_batch_delay = float(os.getenv("WRITE_BATCH_DELAY", "0"))
+db_writes = WriteBatcher(
+    max_delay=write_batch_delay,
+    max_batch=int(os.getenv("WRITE_BATCH_SIZE", "200"))
+) if write_batch_delay > 0 else async_db
+send_queue = SendQueue(
+    bot,
+    workers=int(os.getenv("SEND_WORKERS", "4")),
+    global_rate=float(os.getenv("SEND_GLOBAL_RATE", "30")),
+    chat_rate=float(os.getenv("SEND_CHAT_RATE", "1")),
+    group_rate=float(os.getenv("SEND_GROUP_RATE", "0.33"))
+)
+
+
+def get_username(user: types.User):
+    return user.username or str(user.id)
+
+
+async def notify_throttled(update: types.Update, rule: str):
+    if update.message is not None and update.message.from_user is not None:
+        send_queue.send_message(update.message.from_user.id, "⏳ Слишком много запросов, подождите немного.")
+    elif update.callback_query is not None:
+        send_queue.submit(update.callback_query.answer("⏳ Слишком часто, подождите немного."))
+
+
+throttling = ThrottlingMiddleware(
+    rate=float(os.getenv("THROTTLE_RATE", "1")),
+    burst=int(os.getenv("THROTTLE_BURST", "10")),
+    commands={
+        'reregister': (1 / 60, 2),
+        'start': (1 / 10, 3),
+        'contact': (1 / 10, 3),
+        '👨🦰 Аккаунт': (1 / 5, 3),
+        '🔢 Создать уникальный код': (1 / 2, 5),
+        'codes': (1 / 10, 3),
+    },
+    notify=notify_throttled
+)
+dp.update.outer_middleware(throttling)
+albums = AlbumMiddleware(latency=float(os.getenv("ALBUM_LATENCY", "0.5")))
+dp.message.outer_middleware(albums)
 
 
 class TicketCreatingStates(StatesGroup):
+    choosing_subject = State()
     waiting_for_ticket_subject = State()
     done = State()
 
@@ -50,17 +123,18 @@ class RegistrationStates(StatesGroup):
 async def command_reregister(message: types.Message, state: FSMContext):
     await state.clear()
 
-    username = message.from_user.username or str(message.from_user.id)
-    user_info = db.get_user_status(username)
+    user_id = message.from_user.id
+    user_info = await async_db.get_user_status(user_id, get_username(message.from_user))
 
     if user_info:
         role = user_info['role']
         if role == 'student':
-            db.delete_student(username)
+            await async_db.delete_student(user_id)
         elif role == 'cooteacher':
-            db.delete_cooteacher(username)
+            await async_db.delete_cooteacher(user_id)
+            matching.remove_expert(user_id)
         elif role == 'teacher':
-            db.delete_teacher(username)
+            await async_db.delete_teacher(user_id)
         await message.answer("♻️ Начинаем процесс перерегистрации...")
         await send_welcome(message)
     else:
@@ -90,7 +164,7 @@ async def process_grade(message: types.Message, state: FSMContext):
     data = await state.get_data()
     username = data.get('username')
     if not username:
-        username = message.from_user.username or str(message.from_user.id)
+        username = get_username(message.from_user)
         await state.update_data(username=username)
 
     required_fields = ['first_name', 'second_name', 'phone_num']
@@ -100,7 +174,12 @@ async def process_grade(message: types.Message, state: FSMContext):
 
     try:
         grade = int(message.text)
-        db.add_student(
+        if data.get('role') == 'role_cooteacher':
+            await state.update_data(grade=grade)
+            await ask_for_teacher_code(message, state)
+            return
+        await db_writes.add_student(
+            user_id=message.from_user.id,
             username=username,
             first_name=data['first_name'],
             second_name=data['second_name'],
@@ -126,7 +205,8 @@ async def process_subject(callback_query: types.CallbackQuery, state: FSMContext
     data = await state.get_data()
 
     if data['role'] == 'role_teacher':
-        db.add_teacher(
+        await db_writes.add_teacher(
+            user_id=callback_query.from_user.id,
             username=data['username'],
             first_name=data['first_name'],
             last_name=data.get('second_name', ''),
@@ -138,13 +218,18 @@ async def process_subject(callback_query: types.CallbackQuery, state: FSMContext
         await state.clear()
 
     elif data['role'] == 'role_cooteacher':
-        cancel_keyboard = ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text="❌ Отмена")]],
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
-        await callback_query.message.answer("🔢 Введите код учителя:", reply_markup=cancel_keyboard)
-        await state.set_state(RegistrationStates.waiting_for_teacher_code)
+        await callback_query.message.answer("🔢 Введите ваш класс:")
+        await state.set_state(RegistrationStates.waiting_for_grade)
+
+
+async def ask_for_teacher_code(message: types.Message, state: FSMContext):
+    cancel_keyboard = ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text="❌ Отмена")]],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
+    await message.answer("🔢 Введите код учителя:", reply_markup=cancel_keyboard)
+    await state.set_state(RegistrationStates.waiting_for_teacher_code)
 
 
 @dp.callback_query(RegistrationStates.waiting_for_teacher_code)
@@ -163,39 +248,36 @@ async def process_teacher_code(message: types.Message, state: FSMContext):
         return
 
     code = message.text.strip().upper()
-    code_info = db.get_teacher_code_info(code)
     data = await state.get_data()
 
-    if not code_info:
-        return await message.answer("❌ Неверный код")
-    if code_info['used']:
-        return await message.answer("⚠️ Код уже использован")
-    if code_info['subject'] != data.get('subject'):
-        return await message.answer(f"🚫 Код предназначен для предмета: {code_info['subject']}")
-
     try:
-        db.mark_code_as_used(code)
-        db.add_cooteacher(
+        result = await async_db.redeem_teacher_code(
+            code,
+            data.get('subject'),
+            message.from_user.id,
             data['username'],
             data['first_name'],
             data['second_name'],
             data['phone_num'],
-            int(data['grade']),
-            data['subject']
+            int(data['grade']) if data.get('grade') else None
         )
-        await message.answer(f"✅ Регистрация успешна!\nСсылка для чата экспертов: {ADMIN_CHAT_LINK}",
-                             reply_markup=types.ReplyKeyboardRemove())
-        await show_cooteacher_menu(message)
-    except Exception as e:
-        await message.answer("❌ Ошибка регистрации")
-    finally:
+    except Exception:
+        logging.exception("Не удалось зарегистрировать помощника %s по коду", message.from_user.id)
         await state.clear()
+        return await message.answer("❌ Ошибка регистрации")
 
+    if result.status is db.RedeemStatus.INVALID:
+        return await message.answer("❌ Неверный код")
+    if result.status is db.RedeemStatus.USED:
+        return await message.answer("⚠️ Код уже использован")
+    if result.status is db.RedeemStatus.WRONG_SUBJECT:
+        return await message.answer(f"🚫 Код предназначен для предмета: {result.subject}")
 
-def generate_unique_code():
-    characters = string.ascii_uppercase + string.digits
-    code = ''.join(random.choice(characters) for _ in range(5))
-    return code
+    matching.add_expert(message.from_user.id, data.get('subject'), data.get('grade'))
+    await state.clear()
+    await message.answer(f"✅ Регистрация успешна!\nСсылка для чата экспертов: {ADMIN_CHAT_LINK}",
+                         reply_markup=types.ReplyKeyboardRemove())
+    await show_cooteacher_menu(message)
 
 
 @dp.message(Command("start"))
@@ -214,15 +296,21 @@ async def send_welcome(message: types.Message):
 async def handle_contact(message: types.Message, state: FSMContext):
     contact = message.contact
     user_data = {
-        'username': message.from_user.username or str(message.contact.user_id),
+        'username': get_username(message.from_user),
         'first_name': contact.first_name,
         'second_name': contact.last_name or "",
-        'phone_num': contact.phone_number
+        'phone_num': db.normalize_phone(contact.phone_number)
     }
 
     await state.update_data(**user_data)
 
-    user_info = db.get_user_status(user_data['username'])
+    user_info = await async_db.get_user_status(message.from_user.id, user_data['username'])
+    if not user_info and contact.user_id == message.from_user.id:
+        user_info = await async_db.claim_imported_user(
+            message.from_user.id, user_data['username'], user_data['phone_num']
+        )
+        if user_info and user_info['role'] == 'cooteacher' and user_info['data']['approved']:
+            matching.add_expert(message.from_user.id, user_info['data']['subject'], user_info['data']['grade'])
     if user_info:
         await show_profile_by_role(message, user_info)
     else:
@@ -255,17 +343,18 @@ async def ask_for_role(message: types.Message, state: FSMContext):
 
 @dp.message(Command("reregister"))
 async def command_reregister(message: types.Message, state: FSMContext):
-    username = message.from_user.username or str(message.from_user.id)
-    user_info = db.get_user_status(username)
+    user_id = message.from_user.id
+    user_info = await async_db.get_user_status(user_id, get_username(message.from_user))
 
     if user_info:
         role = user_info['role']
         if role == 'student':
-            db.delete_student(username)
+            await async_db.delete_student(user_id)
         elif role == 'cooteacher':
-            db.delete_cooteacher(username)
+            await async_db.delete_cooteacher(user_id)
+            matching.remove_expert(user_id)
         elif role == 'teacher':
-            db.delete_teacher(username)
+            await async_db.delete_teacher(user_id)
         await message.answer("♻️ Начинаем процесс перерегистрации...")
         await send_welcome(message)
     else:
@@ -302,10 +391,9 @@ async def show_teacher_menu(message: types.Message):
     await message.answer("🧑🏫 Меню учителя:", reply_markup=keyboard)
 
 
-@dp.message(lambda message: message.text == "👨🦰 Аккаунт")
+@buttons.button("👨🦰 Аккаунт")
 async def handle_account(message: types.Message):
-    username = message.from_user.username or str(message.from_user.id)
-    user_info = db.get_user_status(username)
+    user_info = await async_db.get_user_status(message.from_user.id, get_username(message.from_user))
 
     if not user_info:
         return await message.answer("❌ Пользователь не найден!")
@@ -364,57 +452,480 @@ async def show_teacher_menu(message: types.Message):
     await message.answer("🧑🏫 Меню учителя:", reply_markup=keyboard)
 
 
-@dp.message(lambda message: message.text == "🔢 Создать уникальный код")
+@buttons.button("🔢 Создать уникальный код")
 async def handle_generate_code(message: types.Message):
-    username = message.from_user.username or str(message.from_user.id)
-    teacher_info = db.get_user_status(username)
+    await issue_codes(message, 1)
+
+
+@dp.message(Command("codes"))
+async def command_codes(message: types.Message, command: CommandObject):
+    try:
+        count = int(command.args or 1)
+    except ValueError:
+        count = 0
+    if not 1 <= count <= MAX_CODES_PER_REQUEST:
+        return await message.answer(f"🔢 Укажите количество кодов от 1 до {MAX_CODES_PER_REQUEST}, например: /codes 10")
+    await issue_codes(message, count)
+
+
+async def issue_codes(message: types.Message, count: int):
+    teacher_info = await async_db.get_user_status(message.from_user.id, get_username(message.from_user))
 
     if not teacher_info or teacher_info['role'] != 'teacher':
         await message.answer("‼️ Только учителя могут создавать коды!")
         return
 
-    code = generate_unique_code()
-    db.add_teacher_code(
+    codes = await code_allocator.issue(
         teacher_id=teacher_info['data']['id'],
-        code=code,
-        subject=teacher_info['data']['subject']
+        subject=teacher_info['data']['subject'],
+        count=count
     )
-    await message.answer(f"✅ Новый код для предмета {teacher_info['data']['subject']}:\n<code>{code}</code>")
+    if count == 1:
+        await message.answer(f"✅ Новый код для предмета {teacher_info['data']['subject']}:\n<code>{codes[0]}</code>")
+    else:
+        await message.answer(
+            f"✅ Новые коды для предмета {teacher_info['data']['subject']}:\n"
+            + "\n".join(f"<code>{code}</code>" for code in codes)
+        )
 
 
-@dp.message(lambda message: message.text == "✍️ Оставить запрос")
+@buttons.button("📋 Список активных запросов")
+async def handle_active_tickets(message: types.Message):
+    user_info = await async_db.get_user_status(message.from_user.id, get_username(message.from_user))
+    if not user_info or user_info['role'] != 'cooteacher':
+        return await message.answer("‼️ Список запросов доступен только помощникам учителя!")
+
+    text, keyboard = await render_ticket_page(user_info['data']['subject'])
+    await message.answer(text, reply_markup=keyboard)
+
+
+async def render_ticket_page(subject: str, after_id: int = 0, before_id: int = None):
+    tickets, has_prev, has_next = await async_db.get_ticket_page(
+        subject, after_id=after_id, before_id=before_id, limit=TICKETS_PER_PAGE
+    )
+    if not tickets:
+        return f"📭 Нет открытых запросов по предмету {subject}.", None
+
+    lines = [f"📋 <b>Открытые запросы: {subject}</b>"]
+    rows = []
+    for ticket in tickets:
+        question = html.quote((ticket['text'] or '')[:80])
+        lines.append(f"\n<b>№{ticket['id']}</b>: {question}")
+        rows.append([InlineKeyboardButton(text=f"✋ Взять №{ticket['id']}", callback_data=f"take_ticket:{ticket['id']}")])
+
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"tickets_prev:{tickets[0]['id']}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="Вперед ▶️", callback_data=f"tickets_next:{tickets[-1]['id']}"))
+    if navigation:
+        rows.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@dp.callback_query(F.data.regexp(r"^tickets_(prev|next):\d+$"))
+async def process_ticket_page(callback_query: types.CallbackQuery):
+    user_info = await async_db.get_user_status(callback_query.from_user.id, get_username(callback_query.from_user))
+    if not user_info or user_info['role'] != 'cooteacher':
+        return await callback_query.answer("‼️ Только для помощников учителя", show_alert=True)
+
+    direction, ticket_id = callback_query.data.split(":")
+    if direction == "tickets_next":
+        text, keyboard = await render_ticket_page(user_info['data']['subject'], after_id=int(ticket_id))
+    else:
+        text, keyboard = await render_ticket_page(user_info['data']['subject'], before_id=int(ticket_id))
+    try:
+        await callback_query.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest:
+        pass
+    await callback_query.answer()
+
+
+@dp.callback_query(F.data.regexp(r"^take_ticket:\d+$"))
+async def process_take_ticket(callback_query: types.CallbackQuery):
+    user_id = callback_query.from_user.id
+    user_info = await async_db.get_user_status(user_id, get_username(callback_query.from_user))
+    if not user_info or user_info['role'] != 'cooteacher':
+        return await callback_query.answer("‼️ Только для помощников учителя", show_alert=True)
+
+    ticket_id = int(callback_query.data.split(":")[1])
+    if not await async_db.assign_ticket(ticket_id, user_id, subject=user_info['data']['subject']):
+        return await callback_query.answer("⚠️ Этот запрос уже взят другим экспертом", show_alert=True)
+
+    matching.assign(user_id)
+    ticket = await async_db.get_ticket(ticket_id)
+    media = json.loads(ticket['media']) if ticket['media'] else None
+    sent = await callback_query.message.answer(
+        f"❓ Запрос №{ticket['id']}, предмет: {ticket['subject']}\n"
+        f"Сообщение: {html.quote(ticket['text'] or '')}\n"
+        + (f"📎 Вложений: {len(media['message_ids'])}\n" if media else "")
+        + "\n↩️ Ответьте на это сообщение, чтобы отправить ответ ученику."
+    )
+    await async_db.add_ticket_message(sent.chat.id, sent.message_id, ticket_id)
+    if media:
+        await relay_ticket_media(ticket_id, sent.chat.id, media)
+    await callback_query.answer(f"✅ Запрос №{ticket_id} закреплен за вами")
+
+
+@buttons.button("✍️ Оставить запрос")
 async def handle_ticket(message: types.Message, state: FSMContext):
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=name, callback_data=f"ticket_subject_{key}")]
+        for key, name in SUBJECTS.items()
+    ])
+    await state.set_state(TicketCreatingStates.choosing_subject)
+    await message.answer("📚 По какому предмету вопрос?", reply_markup=keyboard)
+
+
+@dp.callback_query(TicketCreatingStates.choosing_subject)
+async def process_ticket_choose_subject(callback_query: types.CallbackQuery, state: FSMContext):
+    subject_key = callback_query.data.replace('ticket_subject_', '')
+    if subject_key not in SUBJECTS:
+        await callback_query.message.answer("❌ Неверный предмет, попробуйте снова!")
+        return
+
+    await state.update_data(ticket_subject=SUBJECTS[subject_key])
     await state.set_state(TicketCreatingStates.waiting_for_ticket_subject)
-    await message.answer("✍️ Напишите свой вопрос:")
+    await callback_query.message.answer("✍️ Напишите свой вопрос:")
+
+
+dp.message.register(buttons.dispatch, buttons)
 
 
 @dp.message(TicketCreatingStates.waiting_for_ticket_subject)
-async def process_ticket_subject(message: types.Message, state: FSMContext):
-    await state.update_data(subject=message.text)
+async def process_ticket_subject(message: types.Message, state: FSMContext, album: list = None):
     data = await state.get_data()
-    ticket = f"""
-    ❓ Вопрос от пользователя: {message.from_user.id}
-    Сообщение: {data["subject"]}
-    """
-    await bot.send_message(ADMIN_CHAT_ID, ticket)
+    user_info = await async_db.get_user_status(message.from_user.id, get_username(message.from_user))
+    grade = user_info['data'].get('grade') if user_info and user_info['role'] == 'student' else None
+    text = message_text(message, album)
+    ticket = await ticket_queue.submit(
+        message.from_user.id, data.get("ticket_subject"), text, grade, message_media(message, album)
+    )
     await state.clear()
-    await message.answer("✅ Ваш запрос отправлен экспертам!")
+    sla.schedule(ticket['id'], ticket['created_at'])
+    await message.answer(f"✅ Ваш запрос №{ticket['id']} отправлен экспертам!")
+    if not text:
+        return
+
+    similar = await async_db.search_tickets(
+        text, subject=ticket['subject'], answered=True, exclude_id=ticket['id'], limit=1
+    )
+    if similar and similar[0]['similarity'] >= SUGGEST_SIMILARITY:
+        await message.answer(
+            "💡 Похожий вопрос уже задавали, возможно, ответ поможет, пока эксперт готовит свой:\n\n"
+            + format_found_ticket(similar[0])
+        )
+
+
+def message_text(message: types.Message, album: list = None):
+    return next((m.text or m.caption for m in album or [message] if m.text or m.caption), None)
+
+
+def message_media(message: types.Message, album: list = None):
+    messages = album or [message]
+    if all(m.text for m in messages):
+        return None
+    return {'chat_id': message.chat.id, 'message_ids': [m.message_id for m in messages]}
+
+
+def copy_media(chat_id: int, media: dict, priority: int):
+    return send_queue.submit(CopyMessages(
+        chat_id=chat_id, from_chat_id=media['chat_id'], message_ids=media['message_ids']
+    ), priority=priority)
+
+
+async def relay_ticket_media(ticket_id: int, chat_id: int, media: dict):
+    try:
+        copies = await copy_media(chat_id, media, PRIORITY_NORMAL)
+    except Exception:
+        logging.exception("Не удалось скопировать вложения запроса №%s", ticket_id)
+        return
+    for copy in copies:
+        await async_db.add_ticket_message(chat_id, copy.message_id, ticket_id)
+
+
+def shorten(text: str, limit: int = 300):
+    text = text or ''
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+def format_found_ticket(found: dict):
+    return (
+        f"❓ <b>№{found['id']}:</b> {html.quote(shorten(found['question'], 200))}\n"
+        f"💬 {html.quote(shorten(found['answers'])) if found['answers'] else 'ответа пока нет'}"
+    )
+
+
+async def post_ticket_to_experts(ticket: dict):
+    text = (
+        f"❓ Вопрос от пользователя: {ticket['user_id']}\n"
+        f"Запрос №{ticket['id']}, предмет: {ticket['subject'] or 'не указан'}\n"
+        f"Сообщение: {html.quote(ticket['text'] or '')}"
+    )
+    media = json.loads(ticket['media']) if ticket['media'] else None
+    if media:
+        text += f"\n📎 Вложений: {len(media['message_ids'])}"
+    if ticket['text']:
+        similar = await async_db.search_tickets(
+            ticket['text'], subject=ticket['subject'], answered=True, exclude_id=ticket['id'], limit=3
+        )
+        if similar:
+            text += "\n\n🔎 <b>Похожие вопросы с ответами:</b>\n" + "\n\n".join(map(format_found_ticket, similar))
+    expert_id = matching.pick(ticket['subject'], ticket['grade']) if ticket['subject'] else None
+    if expert_id is not None:
+        if not await async_db.assign_ticket(ticket['id'], expert_id):
+            matching.release(expert_id)
+            return None
+        try:
+            sent = await send_queue.send_message(
+                expert_id,
+                f"{text}\n\n↩️ Ответьте на это сообщение, чтобы отправить ответ ученику.",
+                priority=PRIORITY_NORMAL
+            )
+        except TelegramForbiddenError:
+            logging.warning("Эксперт %s недоступен, запрос №%s уходит в чат экспертов", expert_id, ticket['id'])
+            matching.remove_expert(expert_id)
+            await async_db.unassign_ticket(ticket['id'], expert_id)
+            expert_id = None
+        except Exception:
+            matching.release(expert_id)
+            await async_db.unassign_ticket(ticket['id'], expert_id)
+            raise
+    if expert_id is None:
+        sent = await send_queue.send_message(ADMIN_CHAT_ID, text, priority=PRIORITY_NORMAL)
+    if media:
+        await relay_ticket_media(ticket['id'], sent.chat.id, media)
+    return sent
+
+
+async def on_ticket_overdue(ticket_id: int, stage: int):
+    ticket = await async_db.advance_ticket_sla(ticket_id, stage)
+    if ticket is None:
+        return False
+
+    waited = int((time.time() - ticket['created_at']) // 60)
+    media = json.loads(ticket['media']) if ticket['media'] else None
+    question = (
+        f"Запрос №{ticket['id']}, предмет: {ticket['subject'] or 'не указан'}\n"
+        f"Сообщение: {html.quote(ticket['text'] or '')}\n"
+        + (f"📎 Вложений: {len(media['message_ids'])}\n" if media else "")
+        + "\n↩️ Ответьте на это сообщение, чтобы отправить ответ ученику."
+    )
+    try:
+        if stage == 0:
+            recipients = [ADMIN_CHAT_ID]
+            text = f"⏰ Запрос без ответа уже {waited} мин.\n{question}"
+            student_text = f"⏳ Ваш запрос №{ticket['id']} пока ждет ответа, мы напомнили экспертам."
+        else:
+            recipients = await async_db.get_subject_teachers(ticket['subject'])
+            text = f"🚨 Эскалация: запрос без ответа уже {waited} мин.\n{question}"
+            student_text = f"📣 Ваш запрос №{ticket['id']} передан учителю, ответ скоро будет."
+            if not recipients:
+                recipients = [ADMIN_CHAT_ID]
+                student_text = f"📣 Ваш запрос №{ticket['id']} передан старшим экспертам, ответ скоро будет."
+
+        posts = await asyncio.gather(*(
+            send_queue.send_message(chat_id, text, priority=PRIORITY_NORMAL) for chat_id in recipients
+        ), return_exceptions=True)
+        delivered = [sent for sent in posts if not isinstance(sent, BaseException)]
+        if not delivered:
+            raise posts[0]
+    except Exception:
+        await async_db.revert_ticket_sla(ticket_id, stage)
+        raise
+
+    for sent in delivered:
+        await async_db.add_ticket_message(sent.chat.id, sent.message_id, ticket['id'])
+        if media:
+            await relay_ticket_media(ticket['id'], sent.chat.id, media)
+    send_queue.send_message(ticket['user_id'], student_text, priority=PRIORITY_NORMAL)
+
+
+async def post_ticket_to_admin_chat(ticket: dict):
+    sent = await send_queue.send_message(
+        ADMIN_CHAT_ID,
+        f"⚠️ Запрос №{ticket['id']} не удалось отправить эксперту.\n"
+        f"Вопрос от пользователя: {ticket['user_id']}, предмет: {ticket['subject'] or 'не указан'}\n"
+        f"Сообщение: {ticket['text'] or ''}",
+        priority=PRIORITY_NORMAL,
+        parse_mode=None
+    )
+    if ticket['media']:
+        await relay_ticket_media(ticket['id'], sent.chat.id, json.loads(ticket['media']))
+    return sent
+
+
+ticket_queue = TicketQueue(
+    post_ticket_to_experts, writes=db_writes, fallback=post_ticket_to_admin_chat, owner=WORKER_NAME,
+    park_delay=float(os.getenv("TICKET_PARK_DELAY", "600"))
+)
+sla = SlaScheduler(on_ticket_overdue, delays=(
+    float(os.getenv("SLA_REMIND", str(30 * 60))),
+    float(os.getenv("SLA_ESCALATE", str(2 * 60 * 60)))
+), owner=WORKER_NAME)
+matching = MatchingEngine()
+
+
+async def ticket_reply(message: types.Message):
+    if not message.reply_to_message:
+        return False
+    ticket = await async_db.get_ticket_by_message(message.chat.id, message.reply_to_message.message_id)
+    return {'ticket': ticket} if ticket else False
+
+
+def release_ticket(ticket: dict):
+    sla.cancel(ticket['id'])
+    if ticket['status'] == db.TICKET_ASSIGNED and ticket['assignee_id'] is not None:
+        matching.release(ticket['assignee_id'])
+
+
+@dp.message(Command("stats"), lambda message: message.chat.id == ADMIN_CHAT_ID)
+async def command_stats(message: types.Message):
+    stats = await async_db.get_stats()
+    await message.answer(render_db_stats(stats) + "\n\n" + metrics.metrics.render_summary())
+
+
+def render_db_stats(stats: dict):
+    def breakdown(counts: dict):
+        return ", ".join(f"{key or '—'}: {value}" for key, value in counts.items()) or "нет"
+
+    tickets = stats['tickets']
+    codes = stats['codes']
+    return "\n".join([
+        "📊 <b>База</b>",
+        f"🧑🎓 Учеников: {sum(stats['students'].values())} (по классам: {breakdown(stats['students'])})",
+        f"🧑🔬 Помощников: {sum(stats['cooteachers'].values())} ({breakdown(stats['cooteachers'])})",
+        f"📨 Запросы: ожидают {tickets.get(db.TICKET_WAITING, 0)}, в работе {tickets.get(db.TICKET_ASSIGNED, 0)}, "
+        f"отвечены {tickets.get(db.TICKET_ANSWERED, 0)}, закрыты {tickets.get(db.TICKET_CLOSED, 0)}",
+        f"🔢 Коды: выдано {sum(codes.values())}, использовано {codes.get('used', 0)}",
+    ])
+
+
+async def report_broadcast(broadcast: dict):
+    await send_queue.send_message(
+        ADMIN_CHAT_ID,
+        f"📣 Рассылка №{broadcast['id']} завершена: доставлено {broadcast['sent']}, ошибок {broadcast['failed']}.",
+        priority=PRIORITY_NORMAL
+    )
+
+
+broadcaster = Broadcaster(
+    send_queue,
+    batch_size=int(os.getenv("BROADCAST_BATCH", "50")),
+    on_finish=report_broadcast,
+    owner=WORKER_NAME
+)
+
+
+@dp.message(Command("broadcast"), lambda message: message.chat.id == ADMIN_CHAT_ID)
+async def command_broadcast(message: types.Message, command: CommandObject):
+    if not message.reply_to_message:
+        return await message.answer(
+            "↩️ Ответьте командой /broadcast на сообщение, которое нужно разослать ученикам.\n"
+            f"Можно указать класс и предмет: /broadcast 9 math (предметы: {', '.join(SUBJECTS)})"
+        )
+    grade = subject = None
+    for arg in (command.args or '').split():
+        if arg.isdigit():
+            grade = int(arg)
+        elif arg in SUBJECTS:
+            subject = SUBJECTS[arg]
+        else:
+            return await message.answer(f"❌ Неизвестный фильтр: {html.quote(arg)}")
+
+    broadcast = await broadcaster.create(
+        message.chat.id, message.reply_to_message.message_id, grade, subject, message.from_user.id
+    )
+    await message.answer(
+        f"📣 Рассылка №{broadcast['id']} запущена "
+        f"(класс: {grade or 'все'}, предмет: {subject or 'все'}). Отмена: /broadcast_cancel {broadcast['id']}"
+    )
+
+
+@dp.message(Command("broadcast_cancel"), lambda message: message.chat.id == ADMIN_CHAT_ID)
+async def command_broadcast_cancel(message: types.Message, command: CommandObject):
+    if not (command.args or '').isdigit():
+        return await message.answer("🔢 Укажите номер рассылки, например: /broadcast_cancel 3")
+    broadcast_id = int(command.args)
+    if await broadcaster.cancel(broadcast_id):
+        broadcast = await async_db.get_broadcast(broadcast_id)
+        await message.answer(
+            f"⏹ Рассылка №{broadcast_id} остановлена: доставлено {broadcast['sent']}, ошибок {broadcast['failed']}."
+        )
+    else:
+        await message.answer(f"❌ Рассылка №{broadcast_id} не найдена или уже завершена.")
+
+
+@dp.message(Command("search"))
+async def command_search(message: types.Message, command: CommandObject):
+    if message.chat.id != ADMIN_CHAT_ID:
+        user_info = await async_db.get_user_status(message.from_user.id, get_username(message.from_user))
+        if not user_info or user_info['role'] not in ('cooteacher', 'teacher'):
+            return await message.answer("‼️ Поиск по вопросам доступен только экспертам.")
+    if not command.args:
+        return await message.answer("🔎 Укажите текст для поиска, например: /search квадратное уравнение")
+
+    found = await async_db.search_tickets(command.args, limit=5)
+    if not found:
+        return await message.answer("📭 Ничего не найдено.")
+    await message.answer("🔎 <b>Найдено:</b>\n\n" + "\n\n".join(map(format_found_ticket, found)))
+
+
+@dp.message(Command("close"), ticket_reply)
+async def command_close_ticket(message: types.Message, ticket: dict):
+    if await async_db.close_ticket(ticket['id']):
+        release_ticket(ticket)
+    await message.answer(f"🔒 Запрос №{ticket['id']} закрыт.")
+
+
+@dp.message(Command("close"), lambda message: message.chat.id == ADMIN_CHAT_ID)
+async def command_close_without_ticket(message: types.Message):
+    await message.answer("↩️ Ответьте командой /close на сообщение с открытым запросом.")
+
+
+@dp.message(lambda message: message.chat.id != ADMIN_CHAT_ID, ticket_reply)
+async def handle_expert_reply(message: types.Message, ticket: dict, album: list = None):
+    await deliver_answer(message, ticket, album)
 
 
 @dp.message(lambda message: message.chat.id == ADMIN_CHAT_ID)
-async def handle_admin_group(message: types.Message):
+async def handle_admin_group(message: types.Message, album: list = None):
     if message.reply_to_message:
-        try:
-            original_message = message.reply_to_message.text
-            ticket_id = int(original_message.split("пользователя: ")[1].split("\n")[0].strip())
+        ticket = await async_db.get_ticket_by_message(message.chat.id, message.reply_to_message.message_id)
+        if ticket:
+            await deliver_answer(message, ticket, album)
+
+
+async def relay_answer(user_id: int, header: str, media: dict):
+    await send_queue.send_message(user_id, header, priority=PRIORITY_REPLY)
+    return await copy_media(user_id, media, PRIORITY_REPLY)
+
 
-            await bot.send_message(
-                chat_id=ticket_id,
-                text=f"📨 Ответ от эксперта:\n{message.text}"
+async def deliver_answer(message: types.Message, ticket: dict, album: list = None):
+    try:
+        header = f"📨 Ответ от эксперта на запрос №{ticket['id']}:"
+        media = message_media(message, album)
+        if media is None:
+            delivery = send_queue.send_message(
+                ticket['user_id'], f"{header}\n{message.text}", priority=PRIORITY_REPLY
             )
-            await message.answer("✅ Ответ успешно отправлен!")
-        except Exception as e:
-            print(f"Error processing admin reply: {e}")
+        else:
+            delivery = asyncio.ensure_future(relay_answer(ticket['user_id'], header, media))
+        delivery.add_done_callback(lambda future: confirm_delivery(future, message))
+        await async_db.add_ticket_answer(
+            ticket['id'], message.from_user.id, message.chat.id, message.message_id, message_text(message, album)
+        )
+        release_ticket(ticket)
+    except Exception as e:
+        logging.exception("Error processing admin reply: %s", e)
+
+
+def confirm_delivery(future: asyncio.Future, message: types.Message):
+    if future.cancelled() or future.exception() is not None:
+        text = "⚠️ Не удалось доставить ответ ученику."
+    else:
+        text = "✅ Ответ успешно отправлен!"
+    send_queue.submit(message.answer(text), priority=PRIORITY_NORMAL)
 
 
 async def show_student_profile(message: types.Message, data):
@@ -429,13 +940,109 @@ async def show_teacher_profile(message: types.Message, data):
     await show_teacher_menu(message)
 
 
+def setup_metrics():
+    metrics.setup(dp)
+    metrics.metrics.gauge("bot_send_queue_pending", send_queue.pending)
+    metrics.metrics.gauge("bot_ticket_queue_pending", ticket_queue.pending)
+    metrics.metrics.gauge("bot_ticket_queue_parked", ticket_queue.parked)
+    metrics.metrics.gauge("bot_broadcasts_running", broadcaster.running)
+    metrics.metrics.gauge("bot_sla_pending", sla.pending)
+    metrics.metrics.gauge("bot_throttled_updates", throttling.total_throttled)
+    metrics.metrics.gauge("bot_throttle_buckets", throttling.tracked)
+    metrics.metrics.gauge("bot_album_messages_coalesced", lambda: albums.coalesced)
+    if isinstance(db_writes, WriteBatcher):
+        metrics.metrics.gauge("bot_write_batches", lambda: db_writes.batches)
+        metrics.metrics.gauge("bot_write_batched_rows", lambda: db_writes.rows)
+    metrics.metrics.gauge("bot_role_cache_hits", lambda: db.role_cache_stats()['hits'])
+    metrics.metrics.gauge("bot_role_cache_misses", lambda: db.role_cache_stats()['misses'])
+
+
+async def refresh_matching(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await matching.rebuild()
+        except Exception:
+            logging.exception("Не удалось обновить нагрузку экспертов")
+
+
+async def sync_worker(send_global_rate: float = None, send_group_rate: float = None):
+    await dp.storage.release_cache()
+    db.get_role_cache().clear()
+    if send_global_rate:
+        send_queue.set_global_rate(send_global_rate)
+    if send_group_rate:
+        send_queue.set_group_rate(send_group_rate)
+
+
+async def adopt_worker(owner: str):
+    broadcasts = await async_db.adopt_broadcasts(owner, WORKER_NAME)
+    await broadcaster.resume()
+    tickets = await ticket_queue.adopt(owner)
+    deadlines = await sla.restore()
+    return {'broadcasts': broadcasts, 'tickets': tickets, 'deadlines': deadlines}
+
+
 async def main():
-    await dp.start_polling(bot)
+    setup_metrics()
+    metrics_runner = None
+    if os.getenv("METRICS_PORT"):
+        metrics_runner = await metrics.start_server(
+            host=os.getenv("METRICS_HOST", "127.0.0.1"),
+            port=int(os.getenv("METRICS_PORT"))
+        )
+    send_queue.start()
+    await matching.rebuild()
+    await ticket_queue.start()
+    await sla.start()
+    await broadcaster.start()
+    refresh = None
+    try:
+        mode = os.getenv("BOT_MODE", "polling")
+        if mode == "worker":
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+            refresh = asyncio.create_task(refresh_matching(float(os.getenv("MATCHING_REFRESH", "5"))))
+            await run_worker(
+                dp, bot, sync_worker, adopt_worker,
+                port=int(os.getenv("WORKER_PORT", "8100")),
+                secret=os.getenv("CLUSTER_SECRET") or None,
+                queue_size=int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000")),
+                workers=int(os.getenv("WEBHOOK_WORKERS", "4"))
+            )
+        elif mode == "webhook":
+            await run_webhook(
+                dp, bot,
+                url=os.getenv("WEBHOOK_URL"),
+                path=os.getenv("WEBHOOK_PATH", "/webhook"),
+                host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+                port=int(os.getenv("WEBHOOK_PORT", "8080")),
+                secret=os.getenv("WEBHOOK_SECRET") or None,
+                queue_size=int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000")),
+                workers=int(os.getenv("WEBHOOK_WORKERS", "4"))
+            )
+        else:
+            await dp.start_polling(bot)
+    finally:
+        if refresh is not None:
+            refresh.cancel()
+        await broadcaster.stop()
+        await sla.stop()
+        await ticket_queue.drain(float(os.getenv("DRAIN_TIMEOUT", "30")))
+        await ticket_queue.stop()
+        await send_queue.stop()
+        await dp.storage.close()
+        if isinstance(db_writes, WriteBatcher):
+            await db_writes.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        async_db.shutdown()
+        db.close_pool()
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     try:
         db.init_db()
         asyncio.run(main())
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError):
         print('Бот выключен!')
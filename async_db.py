@@ -0,0 +1,79 @@
+import asyncio
+import functools
+import inspect
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_trace = False
+
+
+def get_executor():
+    global _executor, _trace
+    if _executor is None:
+        _trace = os.getenv("DB_TRACE", "0") == "1"
+        _executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("DB_WORKERS", "1")),
+            thread_name_prefix="db"
+        )
+    return _executor
+
+
+def set_trace(enabled):
+    global _trace
+    get_executor()
+    _trace = enabled
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+async def run(func, *args, **kwargs):
+    executor = get_executor()
+    queued_at = time.perf_counter()
+    timings = []
+
+    def call():
+        timings.append(time.perf_counter())
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings.append(time.perf_counter())
+
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, call)
+    finally:
+        if len(timings) == 2:
+            started_at, finished_at = timings
+            metrics.observe_db(func.__name__, finished_at - started_at, started_at - queued_at)
+            if _trace:
+                logger.info(
+                    "db.%s: queue %.2f ms, run %.2f ms",
+                    func.__name__,
+                    (started_at - queued_at) * 1000,
+                    (finished_at - started_at) * 1000
+                )
+
+
+def __getattr__(name):
+    func = getattr(db, name, None)
+    if not inspect.isfunction(func):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+
+    globals()[name] = wrapper
+    return wrapper
@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import aiohttp
+from aiohttp import web
+
+from loadtest import ADMIN_CHAT_ID, FakeTelegram, percentile
+
+STUDENT_STEPS = (
+    ("start", 1, lambda user: {"text": "/start"}),
+    ("contact", 1, lambda user: {"contact": {
+        "phone_number": f"+7{user:010d}", "first_name": f"User{user}", "user_id": user,
+    }}),
+    ("role", 1, "role_student"),
+    ("grade", 2, lambda user: {"text": str(5 + user % 7)}),
+    ("ticket_button", 1, lambda user: {"text": "✍️ Оставить запрос"}),
+    ("ticket_subject", 1, "ticket_subject_math"),
+    ("ticket_text", 1, lambda user: {"text": f"Вопрос от {user}: как решить уравнение?"}),
+)
+
+
+class CountingTelegram(FakeTelegram):
+    def __init__(self):
+        super().__init__()
+        self.received = {}
+        self._waiters = {}
+
+    async def handle(self, request):
+        before = len(self.sent)
+        response = await super().handle(request)
+        for chat_id, _, _ in self.sent[before:]:
+            self.received[chat_id] = self.received.get(chat_id, 0) + 1
+            waiter = self._waiters.get(chat_id)
+            if waiter is not None and self.received[chat_id] >= waiter[0] and not waiter[1].done():
+                waiter[1].set_result(None)
+        return response
+
+    async def wait(self, chat_id, count, timeout):
+        if self.received.get(chat_id, 0) >= count:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = (count, future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        finally:
+            self._waiters.pop(chat_id, None)
+
+
+class Client:
+    def __init__(self, fake, url, secret, timeout):
+        self.fake = fake
+        self.url = url
+        self.secret = secret
+        self.timeout = timeout
+        self.update_ids = itertools.count(1)
+        self.latencies = {}
+        self.updates = 0
+        self.lost = 0
+        self._session = None
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(headers={"X-Telegram-Bot-Api-Secret-Token": self.secret})
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    def payload(self, user, content):
+        user_info = {"id": user, "is_bot": False, "first_name": f"User{user}"}
+        if isinstance(content, str):
+            return {"update_id": next(self.update_ids), "callback_query": {
+                "id": str(next(self.update_ids)), "from": user_info, "chat_instance": str(user), "data": content,
+                "message": {"message_id": next(self.update_ids), "date": int(time.time()),
+                            "chat": {"id": user, "type": "private"}, "text": "menu"},
+            }}
+        return {"update_id": next(self.update_ids), "message": {
+            "message_id": next(self.update_ids), "date": int(time.time()),
+            "chat": {"id": user, "type": "private"}, "from": user_info, **content(user),
+        }}
+
+    async def student(self, user):
+        expected = 0
+        for label, replies, content in STUDENT_STEPS:
+            expected += replies
+            started = time.perf_counter()
+            async with self._session.post(self.url, json=self.payload(user, content)) as response:
+                response.raise_for_status()
+            self.updates += 1
+            try:
+                await self.fake.wait(user, expected, self.timeout)
+            except asyncio.TimeoutError:
+                self.lost += 1
+                return
+            self.latencies.setdefault(label, []).append(time.perf_counter() - started)
+
+
+async def control(port, method, path):
+    async with aiohttp.ClientSession() as session:
+        async with session.request(method, f"http://127.0.0.1:{port}{path}") as response:
+            return await response.json()
+
+
+async def wait_ready(process, port, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.returncode is not None:
+            raise RuntimeError(f"кластер завершился с кодом {process.returncode}")
+        try:
+            return await control(port, "GET", "/workers")
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("кластер не запустился")
+
+
+async def rebalance(port, delay):
+    await asyncio.sleep(delay)
+    added = await control(port, "POST", "/workers")
+    await asyncio.sleep(delay)
+    drained = await control(port, "POST", "/workers/worker-1/drain")
+    return added, drained
+
+
+async def run_cluster(args, workers, fake):
+    tmp = tempfile.TemporaryDirectory()
+    secret = "bench-secret"
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": "123456:clusterbench",
+        "ADMIN_CHAT": str(ADMIN_CHAT_ID),
+        "DB_PATH": os.path.join(tmp.name, "cluster.db"),
+        "TELEGRAM_API": f"http://127.0.0.1:{args.port}",
+        "BOT_MODE": "webhook",
+        "WEBHOOK_URL": "",
+        "WEBHOOK_HOST": "127.0.0.1",
+        "WEBHOOK_PORT": str(args.port + 1),
+        "WEBHOOK_SECRET": secret,
+        "WORKER_BASE_PORT": str(args.port + 10),
+        "SEND_GLOBAL_RATE": "1000000",
+        "SEND_CHAT_RATE": "1000000",
+        "SEND_GROUP_RATE": "1000000",
+        "THROTTLE_RATE": "1000000",
+        "THROTTLE_BURST": "1000000",
+        "METRICS_PORT": "",
+    })
+    control_port = args.port + 2
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(ROOT, "cluster.py"), "--workers", str(workers),
+        "--control-port", str(control_port), env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=None if args.verbose else asyncio.subprocess.DEVNULL
+    )
+    try:
+        await wait_ready(process, control_port)
+        users = range(1_000_000 * workers, 1_000_000 * workers + args.users)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        async with Client(fake, f"http://127.0.0.1:{args.port + 1}/webhook", secret, args.timeout) as client:
+            async def limited(user):
+                async with semaphore:
+                    await client.student(user)
+
+            started = time.perf_counter()
+            tasks = [asyncio.gather(*map(limited, users))]
+            if args.rebalance:
+                tasks.append(rebalance(control_port, args.rebalance))
+            results = await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+        status = await control(control_port, "GET", "/workers")
+    finally:
+        process.send_signal(signal.SIGTERM)
+        await process.wait()
+        tmp.cleanup()
+
+    latencies = [value for values in client.latencies.values() for value in values]
+    return {
+        "workers": workers,
+        "updates": client.updates,
+        "seconds": elapsed,
+        "updates_per_second": client.updates / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+        "p95_ms": percentile(latencies, 0.95) * 1000 if latencies else None,
+        "lost": client.lost,
+        "rebalance": results[1] if args.rebalance else None,
+        "forwarded": {worker["name"]: worker["forwarded"] for worker in status["workers"]},
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Пропускная способность кластера воркеров против фейкового Bot API")
+    parser.add_argument("--workers", default="1,2,4", help="список размеров кластера через запятую")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=30.0, help="сколько ждать ответа бота на шаг, с")
+    parser.add_argument("--rebalance", type=float, default=0.0,
+                        help="через сколько секунд добавить воркер и затем вывести worker-1 (0 — не менять)")
+    parser.add_argument("--port", type=int, default=8770)
+    parser.add_argument("--verbose", action="store_true", help="показывать логи кластера")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    fake = CountingTelegram()
+    runner = web.AppRunner(fake.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    print(f"ядер: {os.cpu_count()}, пользователей: {args.users}, шагов на пользователя: {len(STUDENT_STEPS)}")
+    print(f"\n{'воркеры':>8} {'обновл./с':>10} {'p50 мс':>8} {'p95 мс':>8} {'потеряно':>9}")
+    results = []
+    for workers in map(int, args.workers.split(",")):
+        result = await run_cluster(args, workers, fake)
+        results.append(result)
+        print(f"{workers:>8} {result['updates_per_second']:>10.0f} {result['p50_ms'] or 0:>8.2f} "
+              f"{result['p95_ms'] or 0:>8.2f} {result['lost']:>9}")
+        print(f"{'':>8} распределение: {json.dumps(result['forwarded'])}")
+        if result["rebalance"]:
+            print(f"{'':>8} перебалансировка: {json.dumps(result['rebalance'], ensure_ascii=False)}")
+
+    tickets = sum(1 for chat_id, _, text in fake.sent if chat_id == ADMIN_CHAT_ID and "Вопрос от пользователя" in text)
+    print(f"\nзапросов доставлено экспертам: {tickets} из {sum(r['updates'] and args.users for r in results)}")
+    await runner.cleanup()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,263 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from aiohttp import web
+
+BOT_ID = 100000
+ADMIN_CHAT_ID = -1001
+EXPERT_ID = 900000
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.message_ids = itertools.count(1)
+        self.calls = {}
+        self.sent = []
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post())
+        if method in ("sendMessage", "editMessageText", "copyMessage"):
+            chat_id = int(params["chat_id"])
+            message_id = next(self.message_ids)
+            self.sent.append((chat_id, message_id, params.get("text", "")))
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bot"},
+                "text": params.get("text", ""),
+            }
+            if method == "copyMessage":
+                result = {"message_id": message_id}
+        elif method == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "Bot", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+class Simulator:
+    def __init__(self, app_module, fake, seed):
+        self.app = app_module
+        self.fake = fake
+        self.rng = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.latencies = {}
+        self.codes = {}
+
+    def user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def message(self, user_id, chat_id=None, **fields):
+        chat_id = chat_id or user_id
+        data = {
+            "message_id": next(self.update_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": self.user(user_id),
+        }
+        data.update(fields)
+        return {"message": data}
+
+    def callback(self, user_id, data):
+        return {"callback_query": {
+            "id": str(next(self.update_ids)),
+            "from": self.user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(self.update_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bot"},
+                "text": "menu",
+            },
+        }}
+
+    async def feed(self, label, payload):
+        from aiogram import types
+        payload["update_id"] = next(self.update_ids)
+        update = types.Update.model_validate(payload, context={"bot": self.app.bot})
+        started = time.perf_counter()
+        await self.app.dp.feed_update(self.app.bot, update)
+        self.latencies.setdefault(label, []).append(time.perf_counter() - started)
+
+    async def register(self, user_id, role):
+        await self.feed("start", self.message(user_id, text="/start"))
+        await self.feed("contact", self.message(user_id, contact={
+            "phone_number": f"+7{user_id:010d}", "first_name": f"User{user_id}", "user_id": user_id,
+        }))
+        await self.feed("role", self.callback(user_id, f"role_{role}"))
+
+    async def teacher(self, user_id, subject):
+        await self.register(user_id, "teacher")
+        await self.feed("subject", self.callback(user_id, f"subject_{subject}"))
+        before = len(self.fake.sent)
+        await self.feed("codes", self.message(user_id, text="/codes 20"))
+        for _, _, text in self.fake.sent[before:]:
+            self.codes.setdefault(subject, []).extend(re.findall(r"<code>(\w+)</code>", text))
+
+    async def cooteacher(self, user_id, subject):
+        await self.register(user_id, "cooteacher")
+        await self.feed("subject", self.callback(user_id, f"subject_{subject}"))
+        await self.feed("grade", self.message(user_id, text=str(self.rng.randint(9, 11))))
+        code = self.codes[subject].pop() if self.codes.get(subject) else "NOCODE"
+        await self.feed("teacher_code", self.message(user_id, text=code))
+
+    async def student(self, user_id, subject):
+        await self.register(user_id, "student")
+        await self.feed("grade", self.message(user_id, text=str(self.rng.randint(5, 11))))
+        await self.feed("account", self.message(user_id, text="👨🦰 Аккаунт"))
+        await self.feed("ticket_button", self.message(user_id, text="✍️ Оставить запрос"))
+        await self.feed("ticket_subject", self.callback(user_id, f"ticket_subject_{subject}"))
+        await self.feed("ticket_text", self.message(user_id, text=f"Вопрос от {user_id}: как решить задачу?"))
+
+    async def reply(self, chat_id, message_id, text):
+        expert_id = EXPERT_ID + message_id if chat_id < 0 else chat_id
+        await self.feed("expert_reply", self.message(
+            expert_id, chat_id=chat_id, text="Ответ эксперта",
+            reply_to_message={
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "text": text,
+            },
+        ))
+
+
+async def run_phase(name, coroutines, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(coroutine):
+        async with semaphore:
+            await coroutine
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(c) for c in coroutines))
+    elapsed = time.perf_counter() - started
+    print(f"{name:<12} {len(coroutines):>6} пользователей за {elapsed:6.2f} с")
+    return elapsed
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота против локального фейкового Bot API")
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--cooteachers", type=int, default=50)
+    parser.add_argument("--teachers", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    os.environ.update({
+        "BOT_TOKEN": "123456:loadtest",
+        "ADMIN_CHAT": str(ADMIN_CHAT_ID),
+        "DB_PATH": os.path.join(tmp.name, "loadtest.db"),
+        "SEND_GLOBAL_RATE": "1000000",
+        "SEND_CHAT_RATE": "1000000",
+        "SEND_GROUP_RATE": "1000000",
+        "THROTTLE_RATE": "1000000",
+        "THROTTLE_BURST": "1000000",
+    })
+
+    fake = FakeTelegram()
+    runner = web.AppRunner(fake.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    from aiogram.client.telegram import TelegramAPIServer
+    import app
+    import async_db
+    import db
+
+    async def send_queue_idle():
+        while app.send_queue.pending() or app.ticket_queue.pending() or await async_db.get_unposted_tickets(limit=1):
+            await asyncio.sleep(0.01)
+
+    app.bot.session.api = TelegramAPIServer.from_base(f"http://127.0.0.1:{args.port}")
+    db.init_db()
+    app.setup_metrics()
+    app.send_queue.start()
+    await app.matching.rebuild()
+    await app.ticket_queue.start()
+
+    sim = Simulator(app, fake, args.seed)
+    subjects = list(app.SUBJECTS)
+    user_ids = itertools.count(1000)
+    phases = {}
+    phases["teachers"] = await run_phase("teachers", [
+        sim.teacher(next(user_ids), subjects[i % len(subjects)]) for i in range(args.teachers)
+    ], args.concurrency)
+    phases["cooteachers"] = await run_phase("cooteachers", [
+        sim.cooteacher(next(user_ids), subjects[i % len(subjects)]) for i in range(args.cooteachers)
+    ], args.concurrency)
+    first_student = next(user_ids)
+    phases["students"] = await run_phase("students", [
+        sim.student(first_student + i, sim.rng.choice(subjects)) for i in range(args.students)
+    ], args.concurrency)
+    await send_queue_idle()
+
+    posts = [(chat_id, message_id, text) for chat_id, message_id, text in fake.sent if "Запрос №" in text
+             and "Вопрос от пользователя" in text]
+    phases["replies"] = await run_phase("replies", [
+        sim.reply(chat_id, message_id, text) for chat_id, message_id, text in posts
+    ], args.concurrency)
+    await send_queue_idle()
+
+    await app.ticket_queue.stop()
+    await app.send_queue.stop()
+    await app.dp.storage.close()
+    await app.bot.session.close()
+    async_db.shutdown()
+    db.close_pool()
+    await runner.cleanup()
+    tmp.cleanup()
+
+    answers = sum(1 for chat_id, _, text in fake.sent if text.startswith("📨 Ответ"))
+    all_latencies = [value for values in sim.latencies.values() for value in values]
+    total_time = sum(phases.values())
+    print(f"\nобновлений: {len(all_latencies)}, {len(all_latencies) / total_time:.0f} в секунду")
+    print(f"запросов отправлено экспертам: {len(posts)}, ответов доставлено: {answers}")
+    print(f"\n{'тип':<16} {'кол-во':>7} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8}")
+    results = {"phases": phases, "updates": len(all_latencies), "tickets": len(posts), "answers": answers,
+               "latency_ms": {}}
+    for label, values in sorted(sim.latencies.items()) + [("ВСЕГО", all_latencies)]:
+        row = {q: percentile(values, q / 100) * 1000 for q in (50, 95, 99)}
+        results["latency_ms"][label] = row
+        print(f"{label:<16} {len(values):>7} {row[50]:>8.2f} {row[95]:>8.2f} {row[99]:>8.2f}")
+    print(f"\nвызовы Bot API: {json.dumps(fake.calls, ensure_ascii=False)}")
+    print(f"средняя задержка: {statistics.mean(all_latencies) * 1000:.2f} мс")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import db
+
+
+def redeem_all(path, worker, codes):
+    db.configure_pool(path=path, size=1)
+    results = []
+    for code in codes:
+        user_id = worker * 1_000_000 + len(results)
+        result = db.redeem_teacher_code(code, "math", user_id, f"u{user_id}", "Имя", "Фамилия", "+7", 9)
+        results.append((code, result.status.value))
+    db.close_pool()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Параллельное погашение одних и тех же кодов учителя")
+    parser.add_argument("--codes", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "stress.db")
+        db.configure_pool(path=path)
+        db.init_db()
+        db.add_teacher(1, "teacher", "Имя", "Фамилия", "+7", "math")
+        codes = [f"C{i:05d}" for i in range(args.codes)]
+        for code in codes:
+            db.add_teacher_code(1, code, "math")
+        db.close_pool()
+
+        started = time.perf_counter()
+        with ProcessPoolExecutor(args.workers) as pool:
+            futures = [pool.submit(redeem_all, path, worker, codes[worker:] + codes[:worker])
+                       for worker in range(args.workers)]
+            results = [item for future in futures for item in future.result()]
+        elapsed = time.perf_counter() - started
+
+        successes = {}
+        for code, status in results:
+            if status == "success":
+                successes[code] = successes.get(code, 0) + 1
+
+        db.configure_pool(path=path)
+        with db.connection() as conn:
+            cooteachers = conn.execute("SELECT COUNT(*) FROM cooteachers").fetchone()[0]
+            used = conn.execute("SELECT COUNT(*) FROM teacher_codes WHERE used = 1").fetchone()[0]
+        db.close_pool()
+
+    print(f"попыток: {len(results)} за {elapsed:.2f} с, успешных: {sum(successes.values())}")
+    print(f"погашено кодов: {used}, помощников: {cooteachers}")
+    ok = (len(successes) == len(codes) and all(n == 1 for n in successes.values())
+          and used == len(codes) and cooteachers == len(codes))
+    print("OK: каждый код погашен ровно один раз" if ok else "ОШИБКА: нарушено однократное погашение")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
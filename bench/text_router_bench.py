@@ -0,0 +1,79 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiogram import Bot, Dispatcher, types
+
+from text_router import TextCommandRouter
+
+BUTTONS = ["👨🦰 Аккаунт", "🔢 Создать уникальный код", "✍️ Оставить запрос", "📋 Список активных запросов"]
+
+
+def make_update(update_id, text):
+    return types.Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        },
+    })
+
+
+async def noop(message: types.Message):
+    pass
+
+
+def lambda_dispatcher(buttons):
+    dp = Dispatcher()
+    dp.message.register(noop, lambda message: message.contact is not None)
+    for text in buttons:
+        dp.message.register(noop, lambda message, text=text: message.text == text)
+    return dp
+
+
+def router_dispatcher(buttons):
+    dp = Dispatcher()
+    router = TextCommandRouter()
+    dp.message.register(noop, lambda message: message.contact is not None)
+    for text in buttons:
+        router.button(text)(noop)
+    dp.message.register(router.dispatch, router)
+    return dp
+
+
+async def measure(dp, bot, updates, rounds):
+    for update in updates:
+        await dp.feed_update(bot, update)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for update in updates:
+            await dp.feed_update(bot, update)
+    return (time.perf_counter() - started) / (rounds * len(updates)) * 1e6
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Стоимость диспетчеризации кнопок меню")
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--buttons", type=int, nargs="+", default=[4, 20, 100])
+    args = parser.parse_args()
+
+    bot = Bot("123456:bench")
+    print(f"{'кнопок':>7} {'lambda, мкс':>12} {'dict, мкс':>10}")
+    for count in args.buttons:
+        buttons = (BUTTONS + [f"Кнопка {i}" for i in range(count)])[:count]
+        updates = [make_update(i, text) for i, text in enumerate([buttons[-1], buttons[0], "обычный текст"])]
+        before = await measure(lambda_dispatcher(buttons), bot, updates, args.rounds)
+        after = await measure(router_dispatcher(buttons), bot, updates, args.rounds)
+        print(f"{count:>7} {before:>12.1f} {after:>10.1f}")
+    await bot.session.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+
+from aiogram.methods import CopyMessage
+
+import async_db
+import db
+from sender import PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    def __init__(self, send_queue, batch_size=50, on_finish=None, retry_delay=30.0, owner=None):
+        self.send_queue = send_queue
+        self.owner = owner
+        self.batch_size = batch_size
+        self.on_finish = on_finish
+        self.retry_delay = retry_delay
+        self._tasks = {}
+
+    async def start(self):
+        await self.resume()
+
+    async def resume(self):
+        for broadcast in await async_db.get_running_broadcasts(self.owner):
+            if broadcast['id'] in self._tasks:
+                continue
+            logger.info("Возобновляем рассылку #%s с user_id > %s", broadcast['id'], broadcast['last_user_id'])
+            self._launch(broadcast)
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def create(self, from_chat_id, message_id, grade=None, subject=None, created_by=None):
+        broadcast = await async_db.add_broadcast(from_chat_id, message_id, grade, subject, created_by, self.owner)
+        self._launch(broadcast)
+        return broadcast
+
+    async def cancel(self, broadcast_id):
+        cancelled = await async_db.cancel_broadcast(broadcast_id)
+        task = self._tasks.pop(broadcast_id, None)
+        if task is not None:
+            task.cancel()
+        return cancelled
+
+    def running(self):
+        return len(self._tasks)
+
+    def _launch(self, broadcast):
+        task = asyncio.create_task(self._run(broadcast))
+        self._tasks[broadcast['id']] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast['id'], None))
+
+    async def _run(self, broadcast):
+        while True:
+            try:
+                finished = await self._send_all(broadcast)
+                break
+            except Exception:
+                logger.exception("Ошибка рассылки #%s, повтор через %s с", broadcast['id'], self.retry_delay)
+                await asyncio.sleep(self.retry_delay)
+                broadcast = await async_db.get_broadcast(broadcast['id'])
+        if finished and self.on_finish is not None:
+            await self.on_finish(await async_db.get_broadcast(broadcast['id']))
+
+    async def _send_all(self, broadcast):
+        after_id = broadcast['last_user_id']
+        while True:
+            recipients = await async_db.get_broadcast_recipients(
+                after_id, broadcast['grade'], broadcast['subject'], self.batch_size
+            )
+            if not recipients:
+                return await async_db.checkpoint_broadcast(
+                    broadcast['id'], after_id, 0, 0, status=db.BROADCAST_DONE
+                )
+            futures = [
+                self.send_queue.submit(CopyMessage(
+                    chat_id=user_id, from_chat_id=broadcast['from_chat_id'], message_id=broadcast['message_id']
+                ), priority=PRIORITY_BULK)
+                for user_id in recipients
+            ]
+            try:
+                await asyncio.gather(*futures, return_exceptions=True)
+            except asyncio.CancelledError:
+                done = 0
+                while done < len(futures) and futures[done].done() and not futures[done].cancelled():
+                    done += 1
+                if done:
+                    await self._checkpoint(broadcast, recipients[done - 1], futures[:done])
+                raise
+            after_id = recipients[-1]
+            if not await self._checkpoint(broadcast, after_id, futures):
+                return False
+
+    async def _checkpoint(self, broadcast, last_user_id, futures):
+        failed = sum(future.cancelled() or future.exception() is not None for future in futures)
+        return await async_db.checkpoint_broadcast(broadcast['id'], last_user_id, len(futures) - failed, failed)
@@ -0,0 +1,33 @@
+import argparse
+import sys
+
+from dotenv import load_dotenv
+
+import db
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка таблицы счетчиков stats_counters по исходным таблицам")
+    parser.add_argument("--db", help="путь к файлу базы (по умолчанию DB_PATH из .env)")
+    parser.add_argument("--rebuild", action="store_true", help="пересчитать счетчики с нуля, если есть расхождения")
+    args = parser.parse_args()
+
+    load_dotenv()
+    if args.db:
+        db.configure_pool(path=args.db)
+    db.init_db()
+
+    mismatches = db.check_stats(rebuild=args.rebuild)
+    for name, key, stored, actual in mismatches:
+        print(f"{name}[{key}]: в счетчиках {stored}, на самом деле {actual}")
+    if not mismatches:
+        print("Счетчики совпадают с данными")
+    elif args.rebuild:
+        print(f"Исправлено расхождений: {len(mismatches)}")
+    else:
+        print(f"Расхождений: {len(mismatches)}, запустите с --rebuild для пересчета")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
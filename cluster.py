@@ -0,0 +1,506 @@
+import argparse
+import asyncio
+import bisect
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import signal
+import sys
+
+import aiohttp
+from aiogram import Bot, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiohttp import web
+from dotenv import load_dotenv
+
+import db
+from webhook import SECRET_HEADER, WebhookServer
+
+logger = logging.getLogger(__name__)
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.nodes = []
+        self._points = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        self.nodes.append(node)
+        for i in range(self.replicas):
+            point = _hash(f"{node}#{i}")
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def get(self, key):
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[index]
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+def shard_key(update):
+    context = UserContextMiddleware.resolve_event_context(update)
+    if context.user is not None:
+        return context.user.id
+    if context.chat is not None:
+        return context.chat.id
+    return update.update_id
+
+
+class WorkerServer(WebhookServer):
+    def __init__(self, dp, bot, secret, on_sync, on_adopt, queue_size=1000, workers=4):
+        super().__init__(dp, bot, path="/updates", secret=secret, queue_size=queue_size, workers=workers)
+        self.on_sync = on_sync
+        self.on_adopt = on_adopt
+
+    def create_app(self):
+        app = super().create_app()
+        app.router.add_get("/cluster/health", self.handle_health)
+        app.router.add_post("/cluster/sync", self.handle_sync)
+        app.router.add_post("/cluster/adopt", self.handle_adopt)
+        return app
+
+    async def handle(self, request):
+        if not self.authorized(request):
+            self.rejected += 1
+            return web.Response(status=403)
+        payload = await request.json()
+        if self._queue.maxsize - self._queue.qsize() < len(payload):
+            return web.Response(status=503)
+        for data in payload:
+            self._queue.put_nowait(types.Update.model_validate(data, context={"bot": self.bot}))
+        self.received += len(payload)
+        return web.Response()
+
+    async def handle_health(self, request):
+        return web.json_response({"pending": self.pending(), "received": self.received})
+
+    async def handle_sync(self, request):
+        if not self.authorized(request):
+            return web.Response(status=403)
+        await self._queue.join()
+        await self.on_sync(**await request.json())
+        return web.Response()
+
+    async def handle_adopt(self, request):
+        if not self.authorized(request):
+            return web.Response(status=403)
+        return web.json_response(await self.on_adopt(**await request.json()))
+
+
+async def run_worker(dp, bot, on_sync, on_adopt, host="127.0.0.1", port=8100, secret=None,
+                     queue_size=1000, workers=4):
+    server = WorkerServer(dp, bot, secret, on_sync, on_adopt, queue_size=queue_size, workers=workers)
+    runner = web.AppRunner(server.create_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Воркер слушает http://%s:%s", host, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+class WorkerProcess:
+    def __init__(self, name, port):
+        self.name = name
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.process = None
+        self.queue = asyncio.Queue()
+        self.forwarder = None
+        self.monitor = None
+        self.stopping = False
+        self.forwarded = 0
+
+
+class Supervisor:
+    def __init__(self, workers=2, base_port=8100, send_global_rate=30.0, send_group_rate=0.33,
+                 drain_timeout=30.0, forward_batch=100, start_timeout=60.0, metrics_port=None):
+        self.initial_workers = workers
+        self.base_port = base_port
+        self.send_global_rate = send_global_rate
+        self.send_group_rate = send_group_rate
+        self.drain_timeout = drain_timeout
+        self.forward_batch = forward_batch
+        self.start_timeout = start_timeout
+        self.metrics_port = metrics_port
+        self.secret = secrets.token_urlsafe(32)
+        self.workers = {}
+        self.primary = None
+        self.ring = HashRing()
+        self.routed = 0
+        self._open = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._session = None
+
+    async def start(self):
+        self._session = aiohttp.ClientSession(headers={SECRET_HEADER: self.secret})
+        names = [f"worker-{index}" for index in range(1, self.initial_workers + 1)]
+        self.primary = names[0]
+        adopted = await asyncio.to_thread(db.adopt_orphaned_work, names, self.primary)
+        if any(adopted.values()):
+            logger.info("Задачи без владельца переданы воркеру %s: %s", self.primary, adopted)
+        async with self._lock:
+            await asyncio.gather(*map(self._spawn, names))
+            self.ring = HashRing(self.workers)
+            await self._sync(self.workers.values())
+        self._open.set()
+
+    async def stop(self):
+        self._open.clear()
+        async with self._lock:
+            try:
+                await asyncio.wait_for(self._flush_queues(self.workers.values()), self.drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Не все обновления переданы воркерам до остановки")
+            await asyncio.gather(*(self._stop_worker(worker) for worker in self.workers.values()))
+            self.workers.clear()
+        await self._session.close()
+
+    async def dispatch(self, data, update):
+        await self._open.wait()
+        worker = self.workers[self.ring.get(shard_key(update))]
+        worker.queue.put_nowait(data)
+        self.routed += 1
+
+    async def add_worker(self):
+        async with self._lock:
+            worker = await self._spawn(self._free_name())
+            await self._rebalance(HashRing(self.workers))
+        logger.info("Воркер %s добавлен, всего воркеров: %d", worker.name, len(self.workers))
+        return worker.name
+
+    async def drain_worker(self, name):
+        async with self._lock:
+            worker = self.workers.get(name)
+            if worker is None:
+                raise KeyError(name)
+            if len(self.workers) == 1:
+                raise ValueError("нельзя вывести последний воркер")
+            await self._rebalance(HashRing(other for other in self.workers if other != name))
+            del self.workers[name]
+            await self._stop_worker(worker)
+            if name == self.primary:
+                self.primary = next(iter(self.workers))
+            adopted = await self._post(self.workers[self.primary], "/cluster/adopt", {"owner": name})
+        logger.info("Воркер %s выведен, его задачи переданы %s: %s", name, self.primary, adopted)
+        return adopted
+
+    def status(self):
+        return [
+            {
+                "name": worker.name,
+                "port": worker.port,
+                "pid": worker.process.pid if worker.process else None,
+                "primary": worker.name == self.primary,
+                "in_ring": worker.name in self.ring.nodes,
+                "queued": worker.queue.qsize(),
+                "forwarded": worker.forwarded,
+            }
+            for worker in self.workers.values()
+        ]
+
+    def _free_name(self):
+        index = 1
+        while f"worker-{index}" in self.workers:
+            index += 1
+        return f"worker-{index}"
+
+    def _worker_rates(self, count):
+        return {
+            "send_global_rate": self.send_global_rate / max(1, count),
+            "send_group_rate": self.send_group_rate / max(1, count),
+        }
+
+    async def _spawn(self, name):
+        index = int(name.rsplit("-", 1)[1])
+        worker = self.workers[name] = WorkerProcess(name, self.base_port + index)
+        try:
+            await self._launch(worker, len(self.workers))
+        except Exception:
+            del self.workers[name]
+            raise
+        worker.forwarder = asyncio.create_task(self._forward(worker))
+        worker.monitor = asyncio.create_task(self._watch(worker))
+        return worker
+
+    async def _launch(self, worker, count):
+        rates = self._worker_rates(count)
+        env = dict(os.environ)
+        env.update({
+            "BOT_MODE": "worker",
+            "WORKER_NAME": worker.name,
+            "WORKER_PORT": str(worker.port),
+            "CLUSTER_SECRET": self.secret,
+            "CODE_POOL_OWNER": worker.name,
+            "SEND_GLOBAL_RATE": str(rates["send_global_rate"]),
+            "SEND_GROUP_RATE": str(rates["send_group_rate"]),
+            "METRICS_PORT": str(self.metrics_port + worker.port - self.base_port) if self.metrics_port else "",
+        })
+        worker.process = await asyncio.create_subprocess_exec(
+            sys.executable, APP_PATH, env=env, start_new_session=True
+        )
+        deadline = asyncio.get_running_loop().time() + self.start_timeout
+        while True:
+            if worker.process.returncode is not None:
+                raise RuntimeError(f"воркер {worker.name} завершился при запуске с кодом {worker.process.returncode}")
+            try:
+                async with self._session.get(worker.url + "/cluster/health") as response:
+                    if response.status == 200:
+                        break
+            except aiohttp.ClientError:
+                pass
+            if asyncio.get_running_loop().time() > deadline:
+                worker.process.kill()
+                raise RuntimeError(f"воркер {worker.name} не запустился за {self.start_timeout} с")
+            await asyncio.sleep(0.1)
+        logger.info("Воркер %s запущен (pid %s, порт %s)", worker.name, worker.process.pid, worker.port)
+
+    async def _watch(self, worker):
+        while not worker.stopping:
+            code = await worker.process.wait()
+            if worker.stopping:
+                break
+            logger.error("Воркер %s завершился с кодом %s, перезапускаем", worker.name, code)
+            primary = self.workers.get(self.primary)
+            if primary is not None and primary is not worker:
+                adopted = await self._post(primary, "/cluster/adopt", {"owner": worker.name})
+                logger.info("Задачи упавшего воркера %s переданы %s: %s", worker.name, self.primary, adopted)
+            await asyncio.sleep(1)
+            try:
+                await self._launch(worker, len(self.workers))
+            except RuntimeError:
+                logger.exception("Не удалось перезапустить воркер %s", worker.name)
+
+    async def _stop_worker(self, worker):
+        worker.stopping = True
+        worker.forwarder.cancel()
+        if worker.process.returncode is None:
+            worker.process.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(worker.process.wait(), self.drain_timeout + 10)
+            except asyncio.TimeoutError:
+                logger.warning("Воркер %s не остановился вовремя, завершаем принудительно", worker.name)
+                worker.process.kill()
+                await worker.process.wait()
+        await asyncio.gather(worker.forwarder, worker.monitor, return_exceptions=True)
+
+    async def _rebalance(self, ring):
+        self._open.clear()
+        try:
+            await self._flush_queues(self.workers.values())
+            self.ring = ring
+            await self._sync(self.workers.values())
+        finally:
+            self._open.set()
+
+    async def _flush_queues(self, workers):
+        await asyncio.gather(*(worker.queue.join() for worker in workers))
+
+    async def _sync(self, workers):
+        rates = self._worker_rates(len(self.ring))
+        await asyncio.gather(*(self._post(worker, "/cluster/sync", rates) for worker in workers))
+
+    async def _post(self, worker, path, payload):
+        while True:
+            try:
+                async with self._session.post(worker.url + path, json=payload) as response:
+                    if response.status == 200:
+                        if response.content_type == "application/json":
+                            return await response.json()
+                        return None
+                    logger.warning("Воркер %s ответил %s на %s", worker.name, response.status, path)
+            except aiohttp.ClientError as e:
+                logger.warning("Воркер %s недоступен (%s), повтор", worker.name, e)
+            await asyncio.sleep(0.5)
+
+    async def _forward(self, worker):
+        while True:
+            batch = [await worker.queue.get()]
+            while len(batch) < self.forward_batch and not worker.queue.empty():
+                batch.append(worker.queue.get_nowait())
+            delay = 0.05
+            while True:
+                try:
+                    async with self._session.post(worker.url + "/updates", json=batch) as response:
+                        if response.status == 200:
+                            break
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+            worker.forwarded += len(batch)
+            for _ in batch:
+                worker.queue.task_done()
+
+
+class ControlServer:
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get("/workers", self.handle_list)
+        app.router.add_post("/workers", self.handle_add)
+        app.router.add_post("/workers/{name}/drain", self.handle_drain)
+        return app
+
+    async def handle_list(self, request):
+        return web.json_response({
+            "primary": self.supervisor.primary,
+            "routed": self.supervisor.routed,
+            "workers": self.supervisor.status(),
+        })
+
+    async def handle_add(self, request):
+        try:
+            name = await self.supervisor.add_worker()
+        except RuntimeError as e:
+            return web.json_response({"error": str(e)}, status=500)
+        return web.json_response({"name": name})
+
+    async def handle_drain(self, request):
+        name = request.match_info["name"]
+        try:
+            adopted = await self.supervisor.drain_worker(name)
+        except KeyError:
+            return web.json_response({"error": f"нет воркера {name}"}, status=404)
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=409)
+        return web.json_response({"name": name, "adopted": adopted})
+
+
+class FrontWebhook:
+    def __init__(self, supervisor, bot, path="/webhook", secret=None):
+        self.supervisor = supervisor
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.rejected = 0
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request):
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            self.rejected += 1
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = types.Update.model_validate(data, context={"bot": self.bot})
+        except ValueError:
+            self.rejected += 1
+            return web.Response(status=400)
+        await self.supervisor.dispatch(data, update)
+        return web.Response()
+
+
+async def poll_updates(supervisor, bot, timeout=30):
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=timeout)
+            except Exception as e:
+                logger.warning("Ошибка getUpdates: %s", e)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await supervisor.dispatch(update.model_dump(mode="json", exclude_none=True, by_alias=True), update)
+                offset = update.update_id + 1
+    finally:
+        if offset is not None:
+            await bot.get_updates(offset=offset, timeout=0, limit=1)
+
+
+async def run_cluster(workers, control_host="127.0.0.1", control_port=8090):
+    api = os.getenv("TELEGRAM_API")
+    bot = Bot(
+        token=os.getenv("BOT_TOKEN"),
+        session=AiohttpSession(api=TelegramAPIServer.from_base(api)) if api else None
+    )
+    supervisor = Supervisor(
+        workers=workers,
+        base_port=int(os.getenv("WORKER_BASE_PORT", "8100")),
+        send_global_rate=float(os.getenv("SEND_GLOBAL_RATE", "30")),
+        send_group_rate=float(os.getenv("SEND_GROUP_RATE", "0.33")),
+        drain_timeout=float(os.getenv("DRAIN_TIMEOUT", "30")),
+        forward_batch=int(os.getenv("CLUSTER_FORWARD_BATCH", "100")),
+        metrics_port=int(os.getenv("METRICS_PORT")) if os.getenv("METRICS_PORT") else None
+    )
+    await supervisor.start()
+
+    runners = [web.AppRunner(ControlServer(supervisor).create_app())]
+    await runners[0].setup()
+    await web.TCPSite(runners[0], control_host, control_port).start()
+    logger.info("Управление кластером: http://%s:%s/workers", control_host, control_port)
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+
+    ingress = None
+    try:
+        if os.getenv("BOT_MODE", "polling") == "webhook":
+            path = os.getenv("WEBHOOK_PATH", "/webhook")
+            secret = os.getenv("WEBHOOK_SECRET") or None
+            if not secret:
+                raise ValueError("WEBHOOK_SECRET не задан: без него любой может отправлять боту поддельные обновления")
+            front = FrontWebhook(supervisor, bot, path=path, secret=secret)
+            runners.append(web.AppRunner(front.create_app(), access_log=None))
+            await runners[-1].setup()
+            host, port = os.getenv("WEBHOOK_HOST", "0.0.0.0"), int(os.getenv("WEBHOOK_PORT", "8080"))
+            await web.TCPSite(runners[-1], host, port).start()
+            logger.info("Webhook кластера слушает http://%s:%s%s", host, port, path)
+            if os.getenv("WEBHOOK_URL"):
+                await bot.set_webhook(os.getenv("WEBHOOK_URL").rstrip("/") + path, secret_token=secret)
+        else:
+            await bot.delete_webhook()
+            ingress = asyncio.create_task(poll_updates(supervisor, bot))
+        await stopped.wait()
+    finally:
+        if ingress is not None:
+            ingress.cancel()
+            await asyncio.gather(ingress, return_exceptions=True)
+        for runner in reversed(runners):
+            await runner.cleanup()
+        await supervisor.stop()
+        await bot.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Запуск бота в нескольких процессах-воркерах")
+    parser.add_argument("--workers", type=int, help="число воркеров (по умолчанию CLUSTER_WORKERS или число ядер)")
+    parser.add_argument("--control-port", type=int, help="порт управления (по умолчанию CLUSTER_CONTROL_PORT)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    db.init_db()
+    workers = args.workers or int(os.getenv("CLUSTER_WORKERS") or os.cpu_count() or 1)
+    control_port = args.control_port or int(os.getenv("CLUSTER_CONTROL_PORT", "8090"))
+    asyncio.run(run_cluster(workers, control_port=control_port))
+
+
+if __name__ == '__main__':
+    main()
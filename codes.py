@@ -0,0 +1,50 @@
+import asyncio
+import secrets
+import string
+
+import async_db
+
+ALPHABET = string.ascii_uppercase + string.digits
+
+
+def generate_code(length=5):
+    return ''.join(secrets.choice(ALPHABET) for _ in range(length))
+
+
+class CodeAllocator:
+    def __init__(self, owner="main", length=5, batch_size=200, low_watermark=50):
+        self.owner = owner
+        self.length = length
+        self.batch_size = batch_size
+        self.low_watermark = low_watermark
+        self._codes = []
+        self._issuing = set()
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    def available(self):
+        return len(self._codes)
+
+    async def _refill(self, needed):
+        if not self._loaded:
+            self._codes = await async_db.get_reserved_codes(self.owner)
+            self._loaded = True
+        while len(self._codes) < needed:
+            candidates = {generate_code(self.length) for _ in range(max(self.batch_size, needed))}
+            reserved = await async_db.reserve_codes(candidates, self.owner)
+            self._codes = [code for code in reserved if code not in self._issuing]
+
+    async def issue(self, teacher_id, subject, count=1):
+        async with self._lock:
+            if not self._loaded or len(self._codes) < max(count, self.low_watermark):
+                await self._refill(max(count, self.low_watermark))
+            codes = [self._codes.pop() for _ in range(count)]
+            self._issuing.update(codes)
+        try:
+            await async_db.issue_teacher_codes(teacher_id, subject, codes)
+        except Exception:
+            self._codes.extend(codes)
+            raise
+        finally:
+            self._issuing.difference_update(codes)
+        return codes
@@ -1,167 +1,1028 @@
-from sqlite3 import connect
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from enum import Enum
+from sqlite3 import Error, Row, connect
 
+DB_PATH = 'project.db'
 
-def get_db_connection():
-    conn = connect('project.db')
-    conn.row_factory = dict_factory
+_pool = None
+_init_lock = threading.Lock()
+
+
+def get_db_connection(path=None):
+    conn = connect(
+        path or os.getenv("DB_PATH", DB_PATH),
+        timeout=float(os.getenv("DB_BUSY_TIMEOUT", "5")),
+        check_same_thread=False,
+        cached_statements=int(os.getenv("DB_STATEMENT_CACHE", "256"))
+    )
+    conn.row_factory = Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={int(os.getenv('DB_MMAP_SIZE', str(64 * 1024 * 1024)))}")
+    conn.execute(f"PRAGMA cache_size={int(os.getenv('DB_CACHE_SIZE', '-16000'))}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.create_function("search_terms", 1, search_terms, deterministic=True)
+    conn.create_function("search_terms_json", 1, lambda text: json.dumps(search_terms(text).split()), deterministic=True)
     return conn
 
 
-def dict_factory(cursor, row):
-    return {col[0]: row[idx] for idx, col in enumerate(cursor.description)}
+class ConnectionPool:
+    def __init__(self, path=None, size=4):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
 
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return get_db_connection(self.path)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
 
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    def release(self, conn):
+        self._idle.put(conn)
 
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS students (
-        id INTEGER PRIMARY KEY,
-        username TEXT,
-        first_name TEXT,
-        second_name TEXT,
-        phone_num TEXT,
-        grade INTEGER
-    );
-    ''')
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+def _new_pool(path=None, size=None):
+    return ConnectionPool(
+        path=path,
+        size=size or int(os.getenv("DB_POOL_SIZE", "4"))
+    )
+
+
+def configure_pool(path=None, size=None):
+    global _pool
+    with _init_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = _new_pool(path, size)
+    return _pool
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _init_lock:
+            if _pool is None:
+                _pool = _new_pool()
+    return _pool
+
+
+def close_pool():
+    global _pool
+    with _init_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+MISSING = object()
+
+
+class RoleCache:
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key, MISSING)
+            if item is not MISSING:
+                expires_at, value = item
+                if expires_at > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+            self.misses += 1
+            return MISSING
 
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS teachers (
+    def put(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items)}
+
+
+_role_cache = None
+
+
+def get_role_cache():
+    global _role_cache
+    if _role_cache is None:
+        with _init_lock:
+            if _role_cache is None:
+                _role_cache = RoleCache(
+                    maxsize=int(os.getenv("ROLE_CACHE_SIZE", "10000")),
+                    ttl=float(os.getenv("ROLE_CACHE_TTL", "300"))
+                )
+    return _role_cache
+
+
+@contextmanager
+def connection():
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        with conn:
+            yield conn
+    finally:
+        pool.release(conn)
+
+
+def _migrate_to_1(batch_size, progress):
+    with connection() as conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS students (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            second_name TEXT,
+            phone_num TEXT,
+            grade INTEGER
+        );
+        ''')
+
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS teachers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            first_name TEXT NOT NULL,
+            last_name TEXT,
+            phone_num TEXT NOT NULL,
+            subject TEXT NOT NULL
+        );
+        ''')
+
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS teacher_codes (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT NOT NULL UNIQUE,
-        first_name TEXT NOT NULL,
-        last_name TEXT,
-        phone_num TEXT NOT NULL,
-        subject TEXT NOT NULL
-    );
-    ''')
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS teacher_codes (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    teacher_id INTEGER NOT NULL,
-    code TEXT NOT NULL UNIQUE,
-    used BOOLEAN DEFAULT FALSE,
-    subject TEXT NOT NULL,
-    FOREIGN KEY (teacher_id) REFERENCES teachers(id)
-);
-    ''')
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS cooteachers (
-        id INTEGER PRIMARY KEY,
-        username TEXT,
-        first_name TEXT,
-        second_name TEXT,
-        phone_num TEXT,
-        grade INTEGER,
-        subject TEXT,
-        approved INTEGER DEFAULT 0
-    );
-    ''')
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS tickets (
-        id INTEGER PRIMARY KEY,
-        username TEXT,
-        subject TEXT,
-        status TEXT
+        teacher_id INTEGER NOT NULL,
+        code TEXT NOT NULL UNIQUE,
+        used BOOLEAN DEFAULT FALSE,
+        subject TEXT NOT NULL,
+        FOREIGN KEY (teacher_id) REFERENCES teachers(id)
     );
-    ''')
+        ''')
 
-    conn.commit()
-    conn.close()
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS cooteachers (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            second_name TEXT,
+            phone_num TEXT,
+            grade INTEGER,
+            subject TEXT,
+            approved INTEGER DEFAULT 0
+        );
+        ''')
 
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS tickets (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            subject TEXT,
+            status TEXT
+        );
+        ''')
 
-def add_ticket(username, subject):
-    conn = get_db_connection()
-    conn.execute(
-        "INSERT INTO tickets (username, subject, status) VALUES (?, ?, ?)",
-        (username, subject, "waiting")
-    )
-    conn.commit()
-    conn.close()
-
-
-def get_tickets():
-    conn = get_db_connection()
-    tickets = conn.execute(
-        "SELECT username FROM tickets"
-    ).fetchall()
-    ids = []
-    for x in tickets:
-        ids.append(int(x["username"]))
-    conn.close()
-    return ids
-
-
-def close_ticket(username):
-    conn = get_db_connection()
-    conn.execute("DELETE FROM tickets WHERE username=?", (str(username)))
-    conn.close()
-    return
-
-
-def add_student(username, first_name, second_name, phone_num, grade):
-    conn = get_db_connection()
-    conn.execute(
-        "INSERT INTO students (username, first_name, second_name, phone_num, grade) VALUES (?, ?, ?, ?, ?)",
-        (username, first_name, second_name, phone_num, grade)
-    )
-    conn.commit()
-    conn.close()
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_students_username ON students (username)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cooteachers_username ON cooteachers (username)")
 
 
-def add_cooteacher(username, first_name, second_name, phone_num, grade, subject):
-    conn = get_db_connection()
-    conn.execute(
-        """INSERT INTO cooteachers 
-        (username, first_name, second_name, phone_num, grade, subject) 
-        VALUES (?, ?, ?, ?, ?, ?)""",
-        (username, first_name, second_name, phone_num, grade, subject)
-    )
-    conn.commit()
-    conn.close()
+USER_TABLES = ('students', 'cooteachers', 'teachers', 'tickets')
 
 
-def add_teacher(username, first_name, last_name, phone_num, subject):
-    conn = get_db_connection()
-    conn.execute(
-        "INSERT INTO teachers (username, first_name, last_name, phone_num, subject) VALUES (?, ?, ?, ?, ?)",
-        (username, first_name, last_name or '', phone_num, subject)
-    )
-    conn.commit()
-    conn.close()
+def _table_columns(conn, table):
+    return {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _backfill_user_ids(table, batch_size, progress):
+    with connection() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO migration_progress (name, last_id) VALUES (?, 0)",
+            (f"user_id:{table}",)
+        )
+        last_id = conn.execute(
+            "SELECT last_id FROM migration_progress WHERE name = ?", (f"user_id:{table}",)
+        ).fetchone()['last_id']
+
+    while True:
+        with connection() as conn:
+            rows = conn.execute(
+                f"SELECT id, username FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            conn.executemany(
+                f"UPDATE {table} SET user_id = ? WHERE id = ? AND user_id IS NULL",
+                [(int(row['username']), row['id']) for row in rows
+                 if row['username'] and row['username'].isdigit()]
+            )
+            last_id = rows[-1]['id']
+            conn.execute(
+                "UPDATE migration_progress SET last_id = ? WHERE name = ?",
+                (last_id, f"user_id:{table}")
+            )
+        if progress:
+            progress(f"{table}: обработано до id={last_id}")
+
+
+def _migrate_to_2(batch_size, progress):
+    with connection() as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS migration_progress (name TEXT PRIMARY KEY, last_id INTEGER NOT NULL)"
+        )
+        for table in USER_TABLES:
+            if 'user_id' not in _table_columns(conn, table):
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN user_id INTEGER")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user_id ON {table} (user_id)")
+
+    for table in USER_TABLES:
+        _backfill_user_ids(table, batch_size, progress)
+
+    with connection() as conn:
+        conn.execute("DELETE FROM migration_progress WHERE name LIKE 'user_id:%'")
+
+
+def _migrate_to_3(batch_size, progress):
+    with connection() as conn:
+        columns = _table_columns(conn, 'tickets')
+        for column, definition in (
+            ('text', 'TEXT'),
+            ('assignee_id', 'INTEGER'),
+            ('created_at', 'REAL'),
+            ('updated_at', 'REAL'),
+            ('posted_at', 'REAL'),
+        ):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE tickets ADD COLUMN {column} {definition}")
+        now = time.time()
+        conn.execute(
+            "UPDATE tickets SET created_at = ?, updated_at = ?, posted_at = ? WHERE created_at IS NULL",
+            (now, now, now)
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets (status, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_status_subject ON tickets (status, subject, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_unposted ON tickets (id) WHERE posted_at IS NULL")
+
+
+def _migrate_to_4(batch_size, progress):
+    with connection() as conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS ticket_messages (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            ticket_id INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        ) WITHOUT ROWID;
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ticket_messages_ticket ON ticket_messages (ticket_id)")
+
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS ticket_answers (
+            id INTEGER PRIMARY KEY,
+            ticket_id INTEGER NOT NULL,
+            expert_id INTEGER,
+            chat_id INTEGER,
+            message_id INTEGER,
+            text TEXT,
+            created_at REAL,
+            FOREIGN KEY (ticket_id) REFERENCES tickets(id)
+        );
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ticket_answers_ticket ON ticket_answers (ticket_id)")
+
+
+def _migrate_to_5(batch_size, progress):
+    with connection() as conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID;
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states (updated_at)")
+
+
+def _migrate_to_6(batch_size, progress):
+    with connection() as conn:
+        if 'used_by' not in _table_columns(conn, 'teacher_codes'):
+            conn.execute("ALTER TABLE teacher_codes ADD COLUMN used_by INTEGER")
+
+
+def _migrate_to_7(batch_size, progress):
+    with connection() as conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS code_pool (
+            code TEXT PRIMARY KEY,
+            reserved_by TEXT NOT NULL,
+            reserved_at REAL NOT NULL
+        ) WITHOUT ROWID;
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_code_pool_owner ON code_pool (reserved_by)")
+
+
+def _migrate_to_8(batch_size, progress):
+    with connection() as conn:
+        if 'grade' not in _table_columns(conn, 'tickets'):
+            conn.execute("ALTER TABLE tickets ADD COLUMN grade INTEGER")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_assignee ON tickets (assignee_id, status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cooteachers_subject ON cooteachers (subject, approved)")
+
+
+def _migrate_to_9(batch_size, progress):
+    with connection() as conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY,
+            from_chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            grade INTEGER,
+            subject TEXT,
+            status TEXT NOT NULL,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_by INTEGER,
+            created_at REAL,
+            updated_at REAL
+        );
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_students_grade_user ON students (grade, user_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_user_subject ON tickets (user_id, subject)")
+
+
+def _migrate_to_10(batch_size, progress):
+    with connection() as conn:
+        for table in ('students', 'cooteachers', 'teachers'):
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_phone ON {table} (phone_num)")
+
+
+def _migrate_to_11(batch_size, progress):
+    with connection() as conn:
+        conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS ticket_search USING fts5(
+            question, answers, subject UNINDEXED, tokenize = 'unicode61 remove_diacritics 2'
+        );
+        ''')
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS search_term_stats (term TEXT PRIMARY KEY, docs INTEGER NOT NULL) WITHOUT ROWID"
+        )
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_tickets_search AFTER INSERT ON tickets
+        WHEN new.text IS NOT NULL
+        BEGIN
+            INSERT INTO ticket_search (rowid, question, answers, subject)
+            VALUES (new.id, search_terms(new.text), '', new.subject);
+            INSERT INTO search_term_stats (term, docs)
+            SELECT value, 1 FROM json_each(search_terms_json(new.text)) WHERE true
+            ON CONFLICT (term) DO UPDATE SET docs = docs + 1;
+        END;
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_ticket_answers_search AFTER INSERT ON ticket_answers
+        WHEN new.text IS NOT NULL
+        BEGIN
+            UPDATE ticket_search SET answers = trim(answers || ' ' || search_terms(new.text))
+            WHERE rowid = new.ticket_id;
+            INSERT INTO search_term_stats (term, docs)
+            SELECT value, 1 FROM json_each(search_terms_json(new.text)) WHERE true
+            ON CONFLICT (term) DO UPDATE SET docs = docs + 1;
+        END;
+        ''')
+        after_id = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM ticket_search").fetchone()[0]
+
+    while True:
+        with connection() as conn:
+            ids = [x[0] for x in conn.execute(
+                "SELECT id FROM tickets WHERE id > ? AND text IS NOT NULL ORDER BY id LIMIT ?",
+                (after_id, batch_size)
+            )]
+            if not ids:
+                break
+            conn.execute(
+                """INSERT INTO ticket_search (rowid, question, answers, subject)
+                SELECT t.id, search_terms(t.text), COALESCE((SELECT search_terms(group_concat(a.text, ' '))
+                                                            FROM ticket_answers a WHERE a.ticket_id = t.id), ''),
+                       t.subject
+                FROM tickets t WHERE t.id BETWEEN ? AND ? AND t.text IS NOT NULL""",
+                (ids[0], ids[-1])
+            )
+            conn.execute(
+                """INSERT INTO search_term_stats (term, docs)
+                SELECT terms.value, COUNT(*) FROM ticket_search, json_each(search_terms_json(question || ' ' || answers)) AS terms
+                WHERE ticket_search.rowid BETWEEN ? AND ? GROUP BY terms.value
+                ON CONFLICT (term) DO UPDATE SET docs = docs + excluded.docs""",
+                (ids[0], ids[-1])
+            )
+        after_id = ids[-1]
+        if progress:
+            progress(f"ticket_search: проиндексировано до id {after_id}")
+
+
+def _migrate_to_12(batch_size, progress):
+    with connection() as conn:
+        if 'sla_stage' not in _table_columns(conn, 'tickets'):
+            conn.execute("ALTER TABLE tickets ADD COLUMN sla_stage INTEGER NOT NULL DEFAULT 0")
+
+
+def _migrate_to_13(batch_size, progress):
+    with connection() as conn:
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT NOT NULL, key NOT NULL, value INTEGER NOT NULL, PRIMARY KEY (name, key)
+            ) WITHOUT ROWID"""
+        )
+        for name, (table, key, column) in STATS_COUNTERS.items():
+            new_key, old_key = key.format(row='new'), key.format(row='old')
+            conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{name}_insert AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO stats_counters (name, key, value) VALUES ('{name}', {new_key}, 1)
+                ON CONFLICT (name, key) DO UPDATE SET value = value + 1;
+            END""")
+            conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{name}_delete AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO stats_counters (name, key, value) VALUES ('{name}', {old_key}, -1)
+                ON CONFLICT (name, key) DO UPDATE SET value = value - 1;
+            END""")
+            conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{name}_update AFTER UPDATE OF {column} ON {table}
+            WHEN {old_key} IS NOT {new_key}
+            BEGIN
+                INSERT INTO stats_counters (name, key, value) VALUES ('{name}', {old_key}, -1)
+                ON CONFLICT (name, key) DO UPDATE SET value = value - 1;
+                INSERT INTO stats_counters (name, key, value) VALUES ('{name}', {new_key}, 1)
+                ON CONFLICT (name, key) DO UPDATE SET value = value + 1;
+            END""")
+    check_stats(rebuild=True)
+
+
+def _migrate_to_14(batch_size, progress):
+    with connection() as conn:
+        if 'media' not in _table_columns(conn, 'tickets'):
+            conn.execute("ALTER TABLE tickets ADD COLUMN media TEXT")
+
+
+def _migrate_to_15(batch_size, progress):
+    with connection() as conn:
+        if 'owner' not in _table_columns(conn, 'broadcasts'):
+            conn.execute("ALTER TABLE broadcasts ADD COLUMN owner TEXT")
+
+
+def _migrate_to_16(batch_size, progress):
+    for table in ROSTER_COLUMNS:
+        last_id = 0
+        while True:
+            with connection() as conn:
+                rows = conn.execute(
+                    f"SELECT id, phone_num FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                conn.executemany(
+                    f"UPDATE {table} SET phone_num = ? WHERE id = ?",
+                    [(normalize_phone(row['phone_num']), row['id']) for row in rows
+                     if row['phone_num'] and normalize_phone(row['phone_num']) != row['phone_num']]
+                )
+                last_id = rows[-1]['id']
+            if progress:
+                progress(f"{table}: телефоны нормализованы до id={last_id}")
+        with connection() as conn:
+            shared = conn.execute(
+                f"SELECT COUNT(*) FROM (SELECT phone_num FROM {table} WHERE phone_num != '' "
+                f"GROUP BY phone_num HAVING COUNT(*) > 1)"
+            ).fetchone()[0]
+        if shared and progress:
+            progress(f"{table}: номеров, общих для нескольких записей: {shared} (см. roster.py conflicts {table})")
+
+
+def _migrate_to_17(batch_size, progress):
+    with connection() as conn:
+        conn.execute("DROP TRIGGER IF EXISTS trg_ticket_answers_search")
+        conn.execute('''
+        CREATE TRIGGER trg_ticket_answers_search AFTER INSERT ON ticket_answers
+        WHEN new.text IS NOT NULL
+        BEGIN
+            INSERT INTO search_term_stats (term, docs)
+            SELECT value, 1 FROM json_each(search_terms_json(new.text))
+            WHERE EXISTS (SELECT 1 FROM ticket_search WHERE rowid = new.ticket_id)
+              AND value NOT IN (
+                SELECT terms.value FROM ticket_search, json_each(search_terms_json(question || ' ' || answers)) AS terms
+                WHERE ticket_search.rowid = new.ticket_id
+              )
+            ON CONFLICT (term) DO UPDATE SET docs = docs + 1;
+            UPDATE ticket_search SET answers = trim(answers || ' ' || search_terms(new.text))
+            WHERE rowid = new.ticket_id;
+        END;
+        ''')
+        conn.execute("DELETE FROM search_term_stats")
+
+    after_id = 0
+    while True:
+        with connection() as conn:
+            ids = [x[0] for x in conn.execute(
+                "SELECT rowid FROM ticket_search WHERE rowid > ? ORDER BY rowid LIMIT ?", (after_id, batch_size)
+            )]
+            if not ids:
+                break
+            conn.execute(
+                '''INSERT INTO search_term_stats (term, docs)
+                SELECT terms.value, COUNT(*) FROM ticket_search, json_each(search_terms_json(question || ' ' || answers)) AS terms
+                WHERE ticket_search.rowid BETWEEN ? AND ? GROUP BY terms.value
+                ON CONFLICT (term) DO UPDATE SET docs = docs + excluded.docs''',
+                (ids[0], ids[-1])
+            )
+        after_id = ids[-1]
+        if progress:
+            progress(f"search_term_stats: пересчитано до id {after_id}")
+
+
+def _migrate_to_18(batch_size, progress):
+    with connection() as conn:
+        if 'owner' not in _table_columns(conn, 'tickets'):
+            conn.execute("ALTER TABLE tickets ADD COLUMN owner TEXT")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_tickets_owner_unposted ON tickets (owner, id) WHERE posted_at IS NULL"
+        )
+
+
+MIGRATIONS = {
+    1: _migrate_to_1,
+    2: _migrate_to_2,
+    3: _migrate_to_3,
+    4: _migrate_to_4,
+    5: _migrate_to_5,
+    6: _migrate_to_6,
+    7: _migrate_to_7,
+    8: _migrate_to_8,
+    9: _migrate_to_9,
+    10: _migrate_to_10,
+    11: _migrate_to_11,
+    12: _migrate_to_12,
+    13: _migrate_to_13,
+    14: _migrate_to_14,
+    15: _migrate_to_15,
+    16: _migrate_to_16,
+    17: _migrate_to_17,
+    18: _migrate_to_18,
+}
+SCHEMA_VERSION = max(MIGRATIONS)
+
+
+def get_schema_version():
+    with connection() as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def init_db(batch_size=5000, progress=None):
+    version = get_schema_version()
+    for target in range(version + 1, SCHEMA_VERSION + 1):
+        if progress:
+            progress(f"Применяем миграцию схемы до версии {target}")
+        MIGRATIONS[target](batch_size, progress)
+        with connection() as conn:
+            conn.execute(f"PRAGMA user_version = {target}")
+    return SCHEMA_VERSION
+
+
+TICKET_WAITING = 'waiting'
+TICKET_ASSIGNED = 'assigned'
+TICKET_ANSWERED = 'answered'
+TICKET_CLOSED = 'closed'
+OPEN_TICKET_STATUSES = (TICKET_WAITING, TICKET_ASSIGNED)
+
+
+_INSERT_TICKET = """INSERT INTO tickets (user_id, subject, text, grade, media, status, created_at, updated_at, owner)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) RETURNING *"""
+
+
+def _ticket_row(user_id, subject, text=None, grade=None, media=None, owner=None):
+    now = time.time()
+    return user_id, subject, text, grade, json.dumps(media) if media else None, TICKET_WAITING, now, now, owner
+
+
+def add_ticket(user_id, subject, text=None, grade=None, media=None, owner=None):
+    with connection() as conn:
+        ticket = conn.execute(_INSERT_TICKET, _ticket_row(user_id, subject, text, grade, media, owner)).fetchone()
+    return dict(ticket)
+
+
+def get_ticket(ticket_id):
+    with connection() as conn:
+        ticket = conn.execute("SELECT * FROM tickets WHERE id = ?", (ticket_id,)).fetchone()
+    return dict(ticket) if ticket else None
+
+
+def get_tickets(status=TICKET_WAITING, subject=None, after_id=0, limit=100):
+    with connection() as conn:
+        if subject is None:
+            tickets = conn.execute(
+                "SELECT * FROM tickets WHERE status = ? AND id > ? ORDER BY id LIMIT ?",
+                (status, after_id, limit)
+            ).fetchall()
+        else:
+            tickets = conn.execute(
+                "SELECT * FROM tickets WHERE status = ? AND subject = ? AND id > ? ORDER BY id LIMIT ?",
+                (status, subject, after_id, limit)
+            ).fetchall()
+    return [dict(x) for x in tickets]
+
+
+def get_ticket_page(subject, status=TICKET_WAITING, after_id=0, before_id=None, limit=5):
+    select = "SELECT * FROM tickets WHERE status = ? AND subject = ?"
+    exists = "SELECT 1 FROM tickets WHERE status = ? AND subject = ?"
+    with connection() as conn:
+        if before_id is None:
+            tickets = conn.execute(
+                select + " AND id > ? ORDER BY id LIMIT ?", (status, subject, after_id, limit + 1)
+            ).fetchall()
+            has_next = len(tickets) > limit
+            tickets = tickets[:limit]
+            has_prev = bool(tickets) and conn.execute(
+                exists + " AND id < ? LIMIT 1", (status, subject, tickets[0]['id'])
+            ).fetchone() is not None
+        else:
+            tickets = conn.execute(
+                select + " AND id < ? ORDER BY id DESC LIMIT ?", (status, subject, before_id, limit + 1)
+            ).fetchall()
+            has_prev = len(tickets) > limit
+            tickets = tickets[:limit][::-1]
+            has_next = bool(tickets) and conn.execute(
+                exists + " AND id > ? LIMIT 1", (status, subject, tickets[-1]['id'])
+            ).fetchone() is not None
+    return [dict(x) for x in tickets], has_prev, has_next
+
+
+def get_unposted_tickets(after_id=0, limit=100, owner=None):
+    query = "SELECT * FROM tickets WHERE posted_at IS NULL AND id > ?"
+    params = [after_id]
+    if owner is not None:
+        query += " AND owner = ?"
+        params.append(owner)
+    with connection() as conn:
+        tickets = conn.execute(query + " ORDER BY id LIMIT ?", (*params, limit)).fetchall()
+    return [dict(x) for x in tickets]
+
+
+def adopt_tickets(owner, new_owner):
+    with connection() as conn:
+        tickets = conn.execute(
+            "UPDATE tickets SET owner = ? WHERE owner = ? AND (posted_at IS NULL OR status IN (?, ?)) RETURNING *",
+            (new_owner, owner, *OPEN_TICKET_STATUSES)
+        ).fetchall()
+    return sorted((dict(x) for x in tickets), key=lambda ticket: ticket['id'])
+
+
+def mark_ticket_posted(ticket_id, chat_id=None, message_id=None):
+    with connection() as conn:
+        conn.execute("UPDATE tickets SET posted_at = ? WHERE id = ?", (time.time(), ticket_id))
+        if message_id is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO ticket_messages (chat_id, message_id, ticket_id) VALUES (?, ?, ?)",
+                (chat_id, message_id, ticket_id)
+            )
+
+
+def add_ticket_message(chat_id, message_id, ticket_id):
+    with connection() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO ticket_messages (chat_id, message_id, ticket_id) VALUES (?, ?, ?)",
+            (chat_id, message_id, ticket_id)
+        )
+
+
+def get_ticket_by_message(chat_id, message_id):
+    with connection() as conn:
+        ticket = conn.execute(
+            """SELECT t.* FROM ticket_messages tm
+               JOIN tickets t ON t.id = tm.ticket_id
+               WHERE tm.chat_id = ? AND tm.message_id = ?""",
+            (chat_id, message_id)
+        ).fetchone()
+    return dict(ticket) if ticket else None
+
+
+def add_ticket_answer(ticket_id, expert_id, chat_id, message_id, text):
+    now = time.time()
+    with connection() as conn:
+        conn.execute(
+            """INSERT INTO ticket_answers (ticket_id, expert_id, chat_id, message_id, text, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (ticket_id, expert_id, chat_id, message_id, text, now)
+        )
+        conn.execute(
+            """UPDATE tickets SET status = ?, assignee_id = COALESCE(assignee_id, ?), updated_at = ?
+            WHERE id = ? AND status IN (?, ?)""",
+            (TICKET_ANSWERED, expert_id, now, ticket_id, TICKET_WAITING, TICKET_ASSIGNED)
+        )
+
+
+def get_ticket_answers(ticket_id):
+    with connection() as conn:
+        answers = conn.execute(
+            "SELECT * FROM ticket_answers WHERE ticket_id = ? ORDER BY id", (ticket_id,)
+        ).fetchall()
+    return [dict(x) for x in answers]
+
+
+def assign_ticket(ticket_id, assignee_id, subject=None):
+    query = "UPDATE tickets SET status = ?, assignee_id = ?, updated_at = ? WHERE id = ? AND status = ?"
+    params = [TICKET_ASSIGNED, assignee_id, time.time(), ticket_id, TICKET_WAITING]
+    if subject is not None:
+        query += " AND subject = ?"
+        params.append(subject)
+    with connection() as conn:
+        cursor = conn.execute(query, params)
+    return cursor.rowcount == 1
+
+
+def unassign_ticket(ticket_id, assignee_id):
+    with connection() as conn:
+        cursor = conn.execute(
+            """UPDATE tickets SET status = ?, assignee_id = NULL, updated_at = ?
+            WHERE id = ? AND status = ? AND assignee_id = ?""",
+            (TICKET_WAITING, time.time(), ticket_id, TICKET_ASSIGNED, assignee_id)
+        )
+    return cursor.rowcount == 1
+
+
+def get_cooteacher_loads():
+    with connection() as conn:
+        experts = conn.execute(
+            """SELECT c.user_id, c.subject, c.grade,
+                      (SELECT COUNT(*) FROM tickets t
+                       WHERE t.assignee_id = c.user_id AND t.status = ?) AS load
+               FROM cooteachers c
+               WHERE c.approved = 1 AND c.user_id IS NOT NULL""",
+            (TICKET_ASSIGNED,)
+        ).fetchall()
+    return [dict(x) for x in experts]
+
+
+def close_ticket(ticket_id):
+    with connection() as conn:
+        cursor = conn.execute(
+            "UPDATE tickets SET status = ?, updated_at = ? WHERE id = ? AND status != ?",
+            (TICKET_CLOSED, time.time(), ticket_id, TICKET_CLOSED)
+        )
+        conn.execute("DELETE FROM ticket_messages WHERE ticket_id = ?", (ticket_id,))
+    return cursor.rowcount == 1
+
+
+def get_ticket_deadlines(after_id=0, max_stage=2, limit=1000, owner=None):
+    query = "SELECT id, created_at, sla_stage FROM tickets WHERE status IN (?, ?) AND id > ? AND sla_stage < ?"
+    params = [*OPEN_TICKET_STATUSES, after_id, max_stage]
+    if owner is not None:
+        query += " AND owner = ?"
+        params.append(owner)
+    with connection() as conn:
+        tickets = conn.execute(query + " ORDER BY id LIMIT ?", (*params, limit)).fetchall()
+    return [tuple(x) for x in tickets]
+
+
+def advance_ticket_sla(ticket_id, stage):
+    with connection() as conn:
+        ticket = conn.execute(
+            """UPDATE tickets SET sla_stage = ? WHERE id = ? AND sla_stage = ? AND status IN (?, ?)
+            RETURNING *""",
+            (stage + 1, ticket_id, stage, *OPEN_TICKET_STATUSES)
+        ).fetchone()
+    return dict(ticket) if ticket else None
+
+
+def revert_ticket_sla(ticket_id, stage):
+    with connection() as conn:
+        cursor = conn.execute(
+            "UPDATE tickets SET sla_stage = ? WHERE id = ? AND sla_stage = ?", (stage, ticket_id, stage + 1)
+        )
+    return cursor.rowcount == 1
+
+
+def get_subject_teachers(subject):
+    with connection() as conn:
+        teachers = conn.execute(
+            "SELECT DISTINCT user_id FROM teachers WHERE subject = ? AND user_id IS NOT NULL", (subject,)
+        ).fetchall()
+    return [x['user_id'] for x in teachers]
+
+
+_INSERT_STUDENT = (
+    "INSERT INTO students (user_id, username, first_name, second_name, phone_num, grade) VALUES (?, ?, ?, ?, ?, ?)"
+)
+_INSERT_COOTEACHER = """INSERT INTO cooteachers
+    (user_id, username, first_name, second_name, phone_num, grade, subject)
+    VALUES (?, ?, ?, ?, ?, ?, ?)"""
+_INSERT_TEACHER = (
+    "INSERT INTO teachers (user_id, username, first_name, last_name, phone_num, subject) VALUES (?, ?, ?, ?, ?, ?)"
+)
+_INSERT_TEACHER_CODE = "INSERT INTO teacher_codes (teacher_id, code, used, subject) VALUES (?, ?, ?, ?)"
+
+
+def _student_row(user_id, username, first_name, second_name, phone_num, grade):
+    return user_id, username, first_name, second_name, phone_num, grade
+
+
+def _cooteacher_row(user_id, username, first_name, second_name, phone_num, grade, subject):
+    return user_id, username, first_name, second_name, phone_num, grade, subject
+
+
+def _teacher_row(user_id, username, first_name, last_name, phone_num, subject):
+    return user_id, username, first_name, last_name or '', phone_num, subject
+
+
+def _teacher_code_row(teacher_id, code, subject):
+    return teacher_id, code.upper(), 0, subject
+
+
+def add_student(user_id, username, first_name, second_name, phone_num, grade):
+    with connection() as conn:
+        conn.execute(_INSERT_STUDENT, _student_row(user_id, username, first_name, second_name, phone_num, grade))
+    get_role_cache().invalidate(user_id)
+
+
+def add_cooteacher(user_id, username, first_name, second_name, phone_num, grade, subject):
+    with connection() as conn:
+        conn.execute(
+            _INSERT_COOTEACHER,
+            _cooteacher_row(user_id, username, first_name, second_name, phone_num, grade, subject)
+        )
+    get_role_cache().invalidate(user_id)
+
+
+def add_teacher(user_id, username, first_name, last_name, phone_num, subject):
+    with connection() as conn:
+        conn.execute(_INSERT_TEACHER, _teacher_row(user_id, username, first_name, last_name, phone_num, subject))
+    get_role_cache().invalidate(user_id)
 
 
 def add_teacher_code(teacher_id, code, subject):
-    conn = get_db_connection()
-    conn.execute(
-        """INSERT INTO teacher_codes 
-        (teacher_id, code, used, subject) 
-        VALUES (?, ?, ?, ?)""",
-        (teacher_id, code.upper(), 0, subject)
-    )
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        conn.execute(_INSERT_TEACHER_CODE, _teacher_code_row(teacher_id, code, subject))
 
 
-def mark_code_as_used(code):
-    conn = get_db_connection()
+BatchedInsert = namedtuple('BatchedInsert', ['sql', 'row', 'returning', 'invalidates'])
+
+BATCHED_INSERTS = {
+    'add_student': BatchedInsert(_INSERT_STUDENT, _student_row, False, True),
+    'add_cooteacher': BatchedInsert(_INSERT_COOTEACHER, _cooteacher_row, False, True),
+    'add_teacher': BatchedInsert(_INSERT_TEACHER, _teacher_row, False, True),
+    'add_teacher_code': BatchedInsert(_INSERT_TEACHER_CODE, _teacher_code_row, False, False),
+    'add_ticket': BatchedInsert(_INSERT_TICKET, _ticket_row, True, False),
+}
+
+
+def _insert_rows_one_by_one(conn, insert, rows):
+    results = []
+    for row in rows:
+        conn.execute("SAVEPOINT batch_row")
+        try:
+            cursor = conn.execute(insert.sql, row)
+            results.append(dict(cursor.fetchone()) if insert.returning else None)
+        except Error as e:
+            conn.execute("ROLLBACK TO batch_row")
+            results.append(e)
+        conn.execute("RELEASE batch_row")
+    return results
+
+
+def _insert_rows(conn, insert, rows):
+    if insert.returning:
+        return _insert_rows_one_by_one(conn, insert, rows)
+    conn.execute("SAVEPOINT batch_group")
     try:
+        conn.executemany(insert.sql, rows)
+    except Error:
+        conn.execute("ROLLBACK TO batch_group")
+        conn.execute("RELEASE batch_group")
+        return _insert_rows_one_by_one(conn, insert, rows)
+    conn.execute("RELEASE batch_group")
+    return [None] * len(rows)
+
+
+def write_batch(writes):
+    results = [None] * len(writes)
+    groups = {}
+    for i, (name, args, kwargs) in enumerate(writes):
+        try:
+            row = BATCHED_INSERTS[name].row(*args, **kwargs)
+        except Exception as e:
+            results[i] = e
+        else:
+            groups.setdefault(name, []).append((i, row))
+
+    invalidated = []
+    with connection() as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        for name, entries in groups.items():
+            insert = BATCHED_INSERTS[name]
+            for (i, row), result in zip(entries, _insert_rows(conn, insert, [row for _, row in entries])):
+                results[i] = result
+                if insert.invalidates and not isinstance(result, Exception):
+                    invalidated.append(row[0])
+    for user_id in invalidated:
+        get_role_cache().invalidate(user_id)
+    return results
+
+
+def reserve_codes(candidates, owner):
+    now = time.time()
+    with connection() as conn:
+        conn.executemany(
+            """INSERT OR IGNORE INTO code_pool (code, reserved_by, reserved_at)
+            SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM teacher_codes WHERE code = ?)""",
+            [(code, owner, now, code) for code in candidates]
+        )
+        codes = conn.execute("SELECT code FROM code_pool WHERE reserved_by = ?", (owner,)).fetchall()
+    return [x['code'] for x in codes]
+
+
+def get_reserved_codes(owner):
+    with connection() as conn:
+        codes = conn.execute("SELECT code FROM code_pool WHERE reserved_by = ?", (owner,)).fetchall()
+    return [x['code'] for x in codes]
+
+
+def issue_teacher_codes(teacher_id, subject, codes):
+    with connection() as conn:
+        conn.executemany(
+            "INSERT INTO teacher_codes (teacher_id, code, used, subject) VALUES (?, ?, 0, ?)",
+            [(teacher_id, code, subject) for code in codes]
+        )
+        conn.executemany("DELETE FROM code_pool WHERE code = ?", [(code,) for code in codes])
+
+
+def mark_code_as_used(code):
+    with connection() as conn:
         conn.execute(
             "UPDATE teacher_codes SET used = 1 WHERE code = ?",
             (code.upper(),)
         )
-        conn.commit()
-    finally:
-        conn.close()
 
 
 def get_teacher_code_info(code):
-    conn = get_db_connection()
-    try:
+    with connection() as conn:
         code_info = conn.execute(
             """SELECT tc.*, t.subject as teacher_subject 
                FROM teacher_codes tc
@@ -170,77 +1031,479 @@ def get_teacher_code_info(code):
             (code.upper(),)
         ).fetchone()
 
-        if code_info:
-            return {
-                'id': code_info['id'],
-                'code': code_info['code'],
-                'used': bool(code_info['used']),
-                'subject': code_info['subject'],
-                'teacher_id': code_info['teacher_id'],
-                'teacher_subject': code_info['teacher_subject']
-            }
+    if code_info:
+        return {
+            'id': code_info['id'],
+            'code': code_info['code'],
+            'used': bool(code_info['used']),
+            'subject': code_info['subject'],
+            'teacher_id': code_info['teacher_id'],
+            'teacher_subject': code_info['teacher_subject']
+        }
+    return None
+
+
+class RedeemStatus(Enum):
+    INVALID = 'invalid'
+    USED = 'used'
+    WRONG_SUBJECT = 'wrong_subject'
+    SUCCESS = 'success'
+
+
+Redemption = namedtuple('Redemption', 'status subject')
+
+
+def redeem_teacher_code(code, subject, user_id, username, first_name, second_name, phone_num, grade):
+    code = code.upper()
+    with connection() as conn:
+        redeemed = conn.execute(
+            """UPDATE teacher_codes SET used = 1, used_by = ?
+            WHERE code = ? AND used = 0 AND subject = ?
+            RETURNING subject""",
+            (user_id, code, subject)
+        ).fetchone()
+        if redeemed is None:
+            code_info = conn.execute(
+                "SELECT used, subject FROM teacher_codes WHERE code = ?", (code,)
+            ).fetchone()
+            if code_info is None:
+                return Redemption(RedeemStatus.INVALID, None)
+            if code_info['used']:
+                return Redemption(RedeemStatus.USED, code_info['subject'])
+            return Redemption(RedeemStatus.WRONG_SUBJECT, code_info['subject'])
+
+        conn.execute(
+            """INSERT INTO cooteachers
+            (user_id, username, first_name, second_name, phone_num, grade, subject, approved)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 1)""",
+            (user_id, username, first_name, second_name, phone_num, grade, subject)
+        )
+    get_role_cache().invalidate(user_id)
+    return Redemption(RedeemStatus.SUCCESS, subject)
+
+
+_USER_STATUS_QUERY = """
+    SELECT 'student' AS role, id, json_object(
+        'id', id, 'user_id', user_id, 'username', username, 'first_name', first_name,
+        'second_name', second_name, 'phone_num', phone_num, 'grade', grade
+    ) AS data FROM students WHERE {key} = ?
+    UNION ALL
+    SELECT 'cooteacher', id, json_object(
+        'id', id, 'user_id', user_id, 'username', username, 'first_name', first_name,
+        'second_name', second_name, 'phone_num', phone_num, 'grade', grade,
+        'subject', subject, 'approved', approved
+    ) FROM cooteachers WHERE {key} = ?
+    UNION ALL
+    SELECT 'teacher', id, json_object(
+        'id', id, 'user_id', user_id, 'username', username, 'first_name', first_name,
+        'last_name', last_name, 'phone_num', phone_num, 'subject', subject
+    ) FROM teachers WHERE {key} = ?
+    LIMIT 1
+"""
+_USER_STATUS_BY_ID = _USER_STATUS_QUERY.format(key='user_id')
+_USER_STATUS_BY_LEGACY_USERNAME = _USER_STATUS_QUERY.format(key='user_id IS NULL AND username')
+_ROLE_TABLES = {'student': 'students', 'cooteacher': 'cooteachers', 'teacher': 'teachers'}
+
+
+def get_user_status(user_id, username=None):
+    cache = get_role_cache()
+    cached = cache.get(user_id)
+    if cached is not MISSING:
+        return cached
+    generation = cache.generation
+
+    with connection() as conn:
+        row = conn.execute(_USER_STATUS_BY_ID, (user_id, user_id, user_id)).fetchone()
+        if row is None and username:
+            row = conn.execute(_USER_STATUS_BY_LEGACY_USERNAME, (username, username, username)).fetchone()
+            if row:
+                conn.execute(
+                    f"UPDATE {_ROLE_TABLES[row['role']]} SET user_id = ? WHERE id = ?",
+                    (user_id, row['id'])
+                )
+
+    user_info = None
+    if row:
+        user_info = {'role': row['role'], 'data': json.loads(row['data'])}
+        user_info['data']['user_id'] = user_id
+    cache.put(user_id, user_info, generation)
+    return user_info
+
+
+def role_cache_stats():
+    return get_role_cache().stats()
+
+
+def user_exists(user_id):
+    with connection() as conn:
+        result = conn.execute(
+            "SELECT 1 FROM students WHERE user_id = ? UNION ALL "
+            "SELECT 1 FROM cooteachers WHERE user_id = ? UNION ALL "
+            "SELECT 1 FROM teachers WHERE user_id = ? LIMIT 1",
+            (user_id, user_id, user_id)
+        ).fetchone()
+    return result is not None
+
+
+def delete_student(user_id):
+    with connection() as conn:
+        conn.execute("DELETE FROM students WHERE user_id = ?", (user_id,))
+    get_role_cache().invalidate(user_id)
+
+
+def delete_cooteacher(user_id):
+    with connection() as conn:
+        conn.execute("DELETE FROM cooteachers WHERE user_id = ?", (user_id,))
+    get_role_cache().invalidate(user_id)
+
+
+def delete_teacher(user_id):
+    with connection() as conn:
+        conn.execute("DELETE FROM teachers WHERE user_id = ?", (user_id,))
+    get_role_cache().invalidate(user_id)
+
+
+def get_fsm_record(key, min_updated_at=0):
+    with connection() as conn:
+        record = conn.execute(
+            "SELECT state, data, updated_at FROM fsm_states WHERE key = ? AND updated_at >= ?",
+            (key, min_updated_at)
+        ).fetchone()
+    if record is None:
         return None
-    finally:
-        conn.close()
-
-
-def get_user_status(username):
-    conn = get_db_connection()
-    user_info = conn.execute(
-        "SELECT * FROM students WHERE username = ? LIMIT 1", (username,)
-    ).fetchone()
-    if user_info:
-        conn.close()
-        return {'role': 'student', 'data': user_info}
-
-    user_info = conn.execute(
-        "SELECT * FROM cooteachers WHERE username = ? LIMIT 1", (username,)
-    ).fetchone()
-    if user_info:
-        conn.close()
-        return {'role': 'cooteacher', 'data': user_info}
-
-    user_info = conn.execute(
-        "SELECT * FROM teachers WHERE username = ? LIMIT 1", (username,)
-    ).fetchone()
-    if user_info:
-        conn.close()
-        return {'role': 'teacher', 'data': user_info}
-
-    conn.close()
+    return record['state'], json.loads(record['data']) if record['data'] else {}, record['updated_at']
+
+
+def save_fsm_records(records):
+    upserts = []
+    deletes = []
+    for key, state, data, updated_at in records:
+        if state is None and not data:
+            deletes.append((key,))
+        else:
+            upserts.append((key, state, json.dumps(data, ensure_ascii=False), updated_at))
+    with connection() as conn:
+        conn.executemany(
+            """INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data,
+            updated_at = excluded.updated_at""",
+            upserts
+        )
+        conn.executemany("DELETE FROM fsm_states WHERE key = ?", deletes)
+
+
+def delete_expired_fsm_records(before):
+    with connection() as conn:
+        return conn.execute("DELETE FROM fsm_states WHERE updated_at < ?", (before,)).rowcount
+
+
+BROADCAST_RUNNING = 'running'
+BROADCAST_DONE = 'done'
+BROADCAST_CANCELLED = 'cancelled'
+
+
+def add_broadcast(from_chat_id, message_id, grade=None, subject=None, created_by=None, owner=None):
+    now = time.time()
+    with connection() as conn:
+        row = conn.execute(
+            """INSERT INTO broadcasts (from_chat_id, message_id, grade, subject, status, created_by, owner,
+            created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) RETURNING *""",
+            (from_chat_id, message_id, grade, subject, BROADCAST_RUNNING, created_by, owner, now, now)
+        ).fetchone()
+    return dict(row)
+
+
+def get_broadcast(broadcast_id):
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def get_running_broadcasts(owner=None):
+    query = "SELECT * FROM broadcasts WHERE status = ?"
+    params = [BROADCAST_RUNNING]
+    if owner is not None:
+        query += " AND owner = ?"
+        params.append(owner)
+    with connection() as conn:
+        rows = conn.execute(query + " ORDER BY id", params).fetchall()
+    return [dict(row) for row in rows]
+
+
+def adopt_broadcasts(owner, new_owner):
+    query = "UPDATE broadcasts SET owner = ?, updated_at = ? WHERE status = ?"
+    params = [new_owner, time.time(), BROADCAST_RUNNING]
+    if owner is not None:
+        query += " AND owner = ?"
+        params.append(owner)
+    with connection() as conn:
+        return conn.execute(query, params).rowcount
+
+
+def adopt_orphaned_work(owners, new_owner):
+    placeholders = ', '.join('?' * len(owners))
+    with connection() as conn:
+        broadcasts = conn.execute(
+            f"UPDATE broadcasts SET owner = ?, updated_at = ? WHERE status = ? "
+            f"AND (owner IS NULL OR owner NOT IN ({placeholders}))",
+            (new_owner, time.time(), BROADCAST_RUNNING, *owners)
+        ).rowcount
+        tickets = conn.execute(
+            f"UPDATE tickets SET owner = ? WHERE (posted_at IS NULL OR status IN (?, ?)) "
+            f"AND (owner IS NULL OR owner NOT IN ({placeholders}))",
+            (new_owner, *OPEN_TICKET_STATUSES, *owners)
+        ).rowcount
+    return {'broadcasts': broadcasts, 'tickets': tickets}
+
+
+def get_broadcast_recipients(after_user_id=0, grade=None, subject=None, limit=100):
+    query = "SELECT DISTINCT user_id FROM students WHERE user_id > ?"
+    params = [after_user_id]
+    if grade is not None:
+        query += " AND grade = ?"
+        params.append(grade)
+    if subject is not None:
+        query += " AND EXISTS (SELECT 1 FROM tickets WHERE tickets.user_id = students.user_id AND tickets.subject = ?)"
+        params.append(subject)
+    query += " ORDER BY user_id LIMIT ?"
+    params.append(limit)
+    with connection() as conn:
+        return [row[0] for row in conn.execute(query, params)]
+
+
+def checkpoint_broadcast(broadcast_id, last_user_id, sent, failed, status=BROADCAST_RUNNING):
+    with connection() as conn:
+        return conn.execute(
+            """UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ?, status = ?,
+            updated_at = ? WHERE id = ? AND status = ?""",
+            (last_user_id, sent, failed, status, time.time(), broadcast_id, BROADCAST_RUNNING)
+        ).rowcount == 1
+
+
+def cancel_broadcast(broadcast_id):
+    with connection() as conn:
+        return conn.execute(
+            "UPDATE broadcasts SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+            (BROADCAST_CANCELLED, time.time(), broadcast_id, BROADCAST_RUNNING)
+        ).rowcount == 1
+
+
+ROSTER_COLUMNS = {
+    'students': ('first_name', 'second_name', 'phone_num', 'grade'),
+    'cooteachers': ('first_name', 'second_name', 'phone_num', 'grade', 'subject'),
+    'teachers': ('first_name', 'last_name', 'phone_num', 'subject'),
+}
+_ROSTER_INSERT_EXTRA = {
+    'students': {},
+    'cooteachers': {'approved': "1"},
+    'teachers': {'username': "'phone:' || ?"},
+}
+
+
+def normalize_phone(phone):
+    digits = ''.join(ch for ch in str(phone) if ch.isdigit())
+    if len(digits) == 11 and digits.startswith('8'):
+        digits = '7' + digits[1:]
+    return '+' + digits if digits else ''
+
+
+def _roster_match(conn, table, row):
+    columns = ROSTER_COLUMNS[table]
+    first_name = row[columns.index('first_name')].casefold()
+    candidates = conn.execute(
+        f"SELECT id, first_name FROM {table} WHERE phone_num = ? ORDER BY user_id IS NULL, id",
+        (row[columns.index('phone_num')],)
+    )
+    for candidate in candidates:
+        if (candidate['first_name'] or '').casefold() == first_name:
+            return candidate['id']
     return None
 
 
-def user_exists(username):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT 1 FROM students WHERE username = ? UNION ALL "
-        "SELECT 1 FROM cooteachers WHERE username = ? UNION ALL "
-        "SELECT 1 FROM teachers WHERE username = ? LIMIT 1",
-        (username, username, username)
+def upsert_roster(table, rows):
+    columns = ROSTER_COLUMNS[table]
+    phone_index = columns.index('phone_num')
+    extra = _ROSTER_INSERT_EXTRA[table]
+    update_sql = (
+        f"UPDATE {table} SET {', '.join(f'{column} = ?' for column in columns)} "
+        f"WHERE id = ? RETURNING user_id"
     )
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
+    insert_sql = (
+        f"INSERT INTO {table} ({', '.join(columns + tuple(extra))}) "
+        f"VALUES ({', '.join(['?'] * len(columns) + list(extra.values()))})"
+    )
+    inserted = updated = 0
+    invalidated = []
+    with connection() as conn:
+        for row in rows:
+            row_id = _roster_match(conn, table, row)
+            if row_id is None:
+                conn.execute(insert_sql, (*row, row[phone_index]) if 'username' in extra else row)
+                inserted += 1
+                continue
+            user_id = conn.execute(update_sql, (*row, row_id)).fetchone()['user_id']
+            updated += 1
+            if user_id is not None:
+                invalidated.append(user_id)
+    for user_id in invalidated:
+        get_role_cache().invalidate(user_id)
+    return inserted, updated
+
+
+def iter_roster(table, batch_size=1000):
+    columns = ('id', 'user_id', 'username') + ROSTER_COLUMNS[table]
+    after_id = 0
+    while True:
+        with connection() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(columns)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, batch_size)
+            ).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield tuple(row)
+        after_id = rows[-1]['id']
+
+
+def get_phone_conflicts(table):
+    columns = ('id', 'user_id', 'username') + ROSTER_COLUMNS[table]
+    with connection() as conn:
+        rows = conn.execute(
+            f"SELECT {', '.join(columns)} FROM {table} WHERE phone_num IN "
+            f"(SELECT phone_num FROM {table} WHERE phone_num != '' GROUP BY phone_num HAVING COUNT(*) > 1) "
+            f"ORDER BY phone_num, id"
+        ).fetchall()
+    return [tuple(row) for row in rows]
+
+
+_CLAIM_ORDER = ('teachers', 'cooteachers', 'students')
+
+
+def claim_imported_user(user_id, username, phone_num):
+    phone = normalize_phone(phone_num)
+    if not phone:
+        return None
+    with connection() as conn:
+        for table in _CLAIM_ORDER:
+            if conn.execute(
+                f"UPDATE {table} SET user_id = ?, username = ? WHERE id = "
+                f"(SELECT id FROM {table} WHERE phone_num = ? AND user_id IS NULL ORDER BY id LIMIT 1)",
+                (user_id, username, phone)
+            ).rowcount:
+                break
+        else:
+            return None
+    get_role_cache().invalidate(user_id)
+    return get_user_status(user_id)
+
+
+SEARCH_STOPWORDS = frozenset((
+    'как', 'что', 'это', 'для', 'или', 'при', 'так', 'там', 'тут', 'его', 'она', 'они', 'оно', 'мне', 'меня',
+    'нас', 'вас', 'все', 'всё', 'уже', 'еще', 'ещё', 'был', 'была', 'быть', 'есть', 'нет', 'где', 'когда',
+    'почему', 'зачем', 'какой', 'какая', 'какое', 'какие', 'если', 'чтобы', 'можно', 'нужно', 'надо', 'очень',
+    'помогите', 'пожалуйста', 'подскажите', 'вопрос', 'здравствуйте', 'привет', 'этот', 'эта', 'эти', 'про',
+    'над', 'под', 'без', 'через', 'после', 'перед', 'тоже', 'также', 'только', 'просто', 'понимаю', 'the', 'and',
+))
+_SEARCH_TERM_LENGTH = 6
+_SEARCH_MAX_TERMS = 5
+_SEARCH_COMMON_SHARE = 0.003
+
+
+def search_terms(text):
+    terms = []
+    for word in re.findall(r"\w+", (text or '').lower()):
+        if len(word) >= 3 and not word.isdigit() and word not in SEARCH_STOPWORDS:
+            term = word[:_SEARCH_TERM_LENGTH]
+            if term not in terms:
+                terms.append(term)
+    return ' '.join(terms)
+
+
+def _selective_terms(conn, terms):
+    placeholders = ', '.join('?' * len(terms))
+    frequency = dict(conn.execute(
+        f"SELECT term, docs FROM search_term_stats WHERE term IN ({placeholders})", terms
+    ).fetchall())
+    total = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM ticket_search").fetchone()[0]
+    terms = sorted((term for term in terms if term in frequency), key=frequency.get)
+    common = max(1000, total * _SEARCH_COMMON_SHARE)
+    selective = [term for term in terms if frequency[term] <= common]
+    return (selective or terms[:2])[:_SEARCH_MAX_TERMS]
+
+
+def search_tickets(query, subject=None, answered=False, exclude_id=None, limit=5):
+    terms = search_terms(query).split()
+    if not terms:
+        return []
+    with connection() as conn:
+        match_terms = _selective_terms(conn, terms)
+        if not match_terms:
+            return []
+        sql = "SELECT rowid, bm25(ticket_search, 1.0, 0.3) AS score FROM ticket_search WHERE ticket_search MATCH ?"
+        params = [' OR '.join(f'"{term}"' for term in match_terms)]
+        if subject is not None:
+            sql += " AND subject = ?"
+            params.append(subject)
+        if answered:
+            sql += " AND answers != ''"
+        if exclude_id is not None:
+            sql += " AND rowid != ?"
+            params.append(exclude_id)
+        sql += " ORDER BY score LIMIT ?"
+        params.append(limit)
+        sql = f"""SELECT t.id, t.text AS question, t.subject,
+            (SELECT group_concat(a.text, char(10)) FROM ticket_answers a WHERE a.ticket_id = t.id) AS answers
+            FROM ({sql}) AS found JOIN tickets t ON t.id = found.rowid ORDER BY found.score"""
+        rows = conn.execute(sql, params).fetchall()
+
+    query_terms = set(terms)
+    results = []
+    for row in rows:
+        found = dict(row)
+        question_terms = set(search_terms(found['question']).split())
+        found['similarity'] = len(query_terms & question_terms) / len(query_terms | question_terms)
+        results.append(found)
+    return results
 
 
-def delete_student(username):
-    with connect('project.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM students WHERE username = ?", (username,))
-        conn.commit()
+STATS_COUNTERS = {
+    'students': ('students', "COALESCE({row}.grade, '')", 'grade'),
+    'cooteachers': ('cooteachers', "COALESCE({row}.subject, '')", 'subject'),
+    'tickets': ('tickets', "COALESCE({row}.status, '')", 'status'),
+    'codes': ('teacher_codes', "CASE WHEN {row}.used THEN 'used' ELSE 'unused' END", 'used'),
+}
 
 
-def delete_cooteacher(username):
-    with connect('project.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM cooteachers WHERE username = ?", (username,))
-        conn.commit()
+def get_stats():
+    stats = {name: {} for name in STATS_COUNTERS}
+    with connection() as conn:
+        for row in conn.execute("SELECT name, key, value FROM stats_counters WHERE value != 0 ORDER BY name, key"):
+            stats.setdefault(row['name'], {})[row['key']] = row['value']
+    return stats
 
 
-def delete_teacher(username):
-    with connect('project.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM teachers WHERE username = ?", (username,))
-        conn.commit()
+def check_stats(rebuild=False):
+    with connection() as conn:
+        if rebuild:
+            conn.execute("BEGIN IMMEDIATE")
+        actual = {}
+        for name, (table, key, _) in STATS_COUNTERS.items():
+            for row in conn.execute(f"SELECT {key.format(row=table)}, COUNT(*) FROM {table} GROUP BY 1"):
+                actual[name, row[0]] = row[1]
+        stored = {
+            (row['name'], row['key']): row['value']
+            for row in conn.execute("SELECT name, key, value FROM stats_counters WHERE value != 0")
+        }
+        mismatches = [
+            (name, key, stored.get((name, key), 0), actual.get((name, key), 0))
+            for name, key in sorted(set(actual) | set(stored), key=str)
+            if stored.get((name, key), 0) != actual.get((name, key), 0)
+        ]
+        if rebuild and mismatches:
+            conn.execute("DELETE FROM stats_counters")
+            conn.executemany(
+                "INSERT INTO stats_counters (name, key, value) VALUES (?, ?, ?)",
+                [(name, key, value) for (name, key), value in actual.items()]
+            )
+    return mismatches
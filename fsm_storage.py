@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+import async_db
+
+logger = logging.getLogger(__name__)
+
+
+def make_key(key):
+    return ":".join(str(part) if part is not None else "" for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+    ))
+
+
+class SqliteStorage(BaseStorage):
+    def __init__(self, ttl=24 * 60 * 60, flush_interval=0.05, flush_batch=500, max_hot=10000,
+                 sweep_interval=600):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.max_hot = max_hot
+        self.sweep_interval = sweep_interval
+        self.flushes = 0
+        self._hot = OrderedDict()
+        self._dirty = set()
+        self._flush_needed = None
+        self._task = None
+        self._last_sweep = time.time()
+
+    async def _load(self, key):
+        name = make_key(key)
+        record = self._hot.get(name)
+        now = time.time()
+        if record is not None:
+            if record[2] >= now - self.ttl:
+                self._hot.move_to_end(name)
+                return name, record
+            record = [None, {}, now]
+        else:
+            loaded = await async_db.get_fsm_record(name, now - self.ttl)
+            record = self._hot.get(name)
+            if record is None:
+                record = list(loaded or (None, {}, now))
+        self._hot[name] = record
+        self._evict()
+        return name, record
+
+    def _evict(self):
+        while len(self._hot) > self.max_hot:
+            name = next(iter(self._hot))
+            if name in self._dirty:
+                break
+            del self._hot[name]
+
+    def _touch(self, name, record):
+        record[2] = time.time()
+        self._dirty.add(name)
+        if self._task is None or self._task.done():
+            self._flush_needed = asyncio.Event()
+            self._task = asyncio.create_task(self._flush_loop())
+        if len(self._dirty) >= self.flush_batch:
+            self._flush_needed.set()
+
+    async def set_state(self, key, state=None):
+        name, record = await self._load(key)
+        record[0] = state.state if isinstance(state, State) else state
+        self._touch(name, record)
+
+    async def get_state(self, key):
+        _, record = await self._load(key)
+        return record[0]
+
+    async def set_data(self, key, data):
+        name, record = await self._load(key)
+        record[1] = dict(data)
+        self._touch(name, record)
+
+    async def get_data(self, key):
+        _, record = await self._load(key)
+        return dict(record[1])
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        records = []
+        for name in self._dirty:
+            state, data, updated_at = self._hot[name]
+            records.append((name, state, dict(data), updated_at))
+        self._dirty.clear()
+        try:
+            await async_db.save_fsm_records(records)
+            self.flushes += 1
+        except Exception:
+            self._dirty.update(record[0] for record in records)
+            raise
+        finally:
+            self._evict()
+
+    async def release_cache(self):
+        await self.flush()
+        self._hot = OrderedDict((name, record) for name, record in self._hot.items() if name in self._dirty)
+
+    async def sweep(self):
+        now = time.time()
+        self._last_sweep = now
+        expired = [name for name, record in self._hot.items()
+                   if record[2] < now - self.ttl and name not in self._dirty]
+        for name in expired:
+            del self._hot[name]
+        removed = await async_db.delete_expired_fsm_records(now - self.ttl)
+        if removed:
+            logger.info("Удалено устаревших FSM-состояний: %d", removed)
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            try:
+                await self.flush()
+                if time.time() - self._last_sweep >= self.sweep_interval:
+                    await self.sweep()
+            except Exception:
+                logger.exception("Не удалось сохранить FSM-состояния")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
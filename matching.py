@@ -0,0 +1,87 @@
+import heapq
+import itertools
+
+import async_db
+
+
+class MatchingEngine:
+    def __init__(self):
+        self._heaps = {}
+        self._grades = {}
+        self._experts = {}
+        self._seq = itertools.count()
+
+    async def rebuild(self):
+        experts = await async_db.get_cooteacher_loads()
+        self._heaps.clear()
+        self._grades.clear()
+        self._experts.clear()
+        for expert in experts:
+            self.add_expert(expert['user_id'], expert['subject'], expert['grade'], expert['load'])
+        return len(self._experts)
+
+    def _push(self, user_id):
+        subject, grade, load = self._experts[user_id]
+        heap = self._heaps.setdefault((subject, grade), [])
+        if len(heap) > 4 * len(self._experts) + 64:
+            heap[:] = [entry for entry in heap if self._experts.get(entry[2]) == (subject, grade, entry[0])]
+            heapq.heapify(heap)
+        heapq.heappush(heap, (load, next(self._seq), user_id))
+        self._grades.setdefault(subject, set()).add(grade)
+
+    def _top(self, subject, grade):
+        heap = self._heaps.get((subject, grade))
+        while heap:
+            load, _, user_id = heap[0]
+            expert = self._experts.get(user_id)
+            if expert is not None and expert[0] == subject and expert[1] == grade and expert[2] == load:
+                return load, user_id
+            heapq.heappop(heap)
+        return None
+
+    def add_expert(self, user_id, subject, grade=None, load=0):
+        self._experts[user_id] = (subject, grade, load)
+        self._push(user_id)
+
+    def remove_expert(self, user_id):
+        self._experts.pop(user_id, None)
+
+    def experts(self, subject=None):
+        return [user_id for user_id, expert in self._experts.items() if subject is None or expert[0] == subject]
+
+    def pick(self, subject, grade=None):
+        grades = self._grades.get(subject, ())
+        eligible = [g for g in grades if g is None or grade is None or g >= grade]
+        best = None
+        for candidates in (eligible, grades):
+            for g in candidates:
+                top = self._top(subject, g)
+                if top is not None and (best is None or top < best):
+                    best = top
+            if best is not None:
+                break
+        if best is None:
+            return None
+
+        self.assign(best[1])
+        return best[1]
+
+    def assign(self, user_id):
+        expert = self._experts.get(user_id)
+        if expert is None:
+            return
+        subject, grade, load = expert
+        self._experts[user_id] = (subject, grade, load + 1)
+        self._push(user_id)
+
+    def release(self, user_id):
+        expert = self._experts.get(user_id)
+        if expert is None or expert[2] == 0:
+            return
+        subject, grade, load = expert
+        self._experts[user_id] = (subject, grade, load - 1)
+        self._push(user_id)
+
+    def load(self, user_id):
+        expert = self._experts.get(user_id)
+        return expert[2] if expert else None
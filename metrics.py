@@ -0,0 +1,155 @@
+import bisect
+import time
+
+from aiogram import BaseMiddleware
+from aiohttp import web
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Metrics:
+    def __init__(self):
+        self.started_at = time.time()
+        self.updates = 0
+        self.handler_latency = {}
+        self.handler_errors = {}
+        self.db_latency = {}
+        self.db_wait = {}
+        self.gauges = {}
+
+    def observe_handler(self, name, seconds, error=False):
+        histogram = self.handler_latency.get(name)
+        if histogram is None:
+            histogram = self.handler_latency[name] = Histogram()
+        histogram.observe(seconds)
+        if error:
+            self.handler_errors[name] = self.handler_errors.get(name, 0) + 1
+
+    def observe_db(self, name, seconds, waited):
+        histogram = self.db_latency.get(name)
+        if histogram is None:
+            histogram = self.db_latency[name] = Histogram()
+            self.db_wait[name] = Histogram()
+        histogram.observe(seconds)
+        self.db_wait[name].observe(waited)
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def render_prometheus(self):
+        lines = [
+            "# TYPE bot_updates_total counter",
+            f"bot_updates_total {self.updates}",
+            "# TYPE bot_uptime_seconds gauge",
+            f"bot_uptime_seconds {time.time() - self.started_at:.0f}",
+        ]
+        for metric, label, histograms in (
+            ("bot_handler_seconds", "handler", self.handler_latency),
+            ("bot_db_seconds", "query", self.db_latency),
+            ("bot_db_queue_wait_seconds", "query", self.db_wait),
+        ):
+            lines.append(f"# TYPE {metric} histogram")
+            for name, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, n in zip(histogram.buckets, histogram.counts):
+                    cumulative += n
+                    lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{label}="{name}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.total:.6f}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+        lines.append("# TYPE bot_handler_errors_total counter")
+        for name, n in sorted(self.handler_errors.items()):
+            lines.append(f'bot_handler_errors_total{{handler="{name}"}} {n}')
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {func()}")
+        return "\n".join(lines) + "\n"
+
+    def render_summary(self, limit=8):
+        uptime = max(time.time() - self.started_at, 1)
+        lines = [
+            f"⏱ Аптайм: {uptime / 3600:.1f} ч, обновлений: {self.updates} ({self.updates / uptime:.2f}/с)",
+            f"❗️ Ошибок в обработчиках: {sum(self.handler_errors.values())}",
+        ]
+        for title, histograms in (("Обработчики", self.handler_latency), ("Запросы к БД", self.db_latency)):
+            lines += ["", f"<b>{title}</b> (вызовов, p50/p95/p99 мс):"]
+            top = sorted(histograms.items(), key=lambda item: item[1].count, reverse=True)[:limit]
+            for name, h in top:
+                lines.append(
+                    f"▫️ {name}: {h.count}, "
+                    f"{h.quantile(0.5) * 1000:.1f}/{h.quantile(0.95) * 1000:.1f}/{h.quantile(0.99) * 1000:.1f}"
+                )
+        if self.gauges:
+            lines.append("")
+            lines += [f"▫️ {name}: {func()}" for name, func in sorted(self.gauges.items())]
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+
+class UpdateCounterMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        metrics.updates += 1
+        return await handler(event, data)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        if "button_handler" in data:
+            name = data["button_handler"][0].__name__
+        else:
+            name = getattr(getattr(data.get("handler"), "callback", None), "__name__", "unknown")
+        started_at = time.perf_counter()
+        try:
+            result = await handler(event, data)
+        except Exception:
+            metrics.observe_handler(name, time.perf_counter() - started_at, error=True)
+            raise
+        metrics.observe_handler(name, time.perf_counter() - started_at)
+        return result
+
+
+def setup(dp):
+    dp.update.outer_middleware(UpdateCounterMiddleware())
+    dp.message.middleware(HandlerTimingMiddleware())
+    dp.callback_query.middleware(HandlerTimingMiddleware())
+
+
+async def _handle_metrics(request):
+    return web.Response(text=metrics.render_prometheus(), content_type="text/plain")
+
+
+async def start_server(host="127.0.0.1", port=9100):
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,27 @@
+import argparse
+
+from dotenv import load_dotenv
+
+import db
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграция схемы базы данных до последней версии")
+    parser.add_argument("--db", help="путь к файлу базы (по умолчанию DB_PATH из .env)")
+    parser.add_argument("--batch-size", type=int, default=5000, help="число строк в одной транзакции")
+    args = parser.parse_args()
+
+    load_dotenv()
+    if args.db:
+        db.configure_pool(path=args.db)
+
+    version = db.get_schema_version()
+    if version >= db.SCHEMA_VERSION:
+        print(f"Схема уже актуальна (версия {version})")
+        return
+    db.init_db(batch_size=args.batch_size, progress=print)
+    print(f"Готово: версия схемы {version} -> {db.SCHEMA_VERSION}")
+
+
+if __name__ == '__main__':
+    main()
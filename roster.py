@@ -0,0 +1,115 @@
+import argparse
+import csv
+import sys
+from functools import partial
+
+from dotenv import load_dotenv
+
+import db
+from subjects import SUBJECTS
+
+
+def parse_row(table, record):
+    values = []
+    for column in db.ROSTER_COLUMNS[table]:
+        value = (record.get(column) or '').strip()
+        if column == 'phone_num':
+            value = db.normalize_phone(value)
+            if len(value) < 11:
+                raise ValueError(f"некорректный телефон {record.get(column)!r}")
+        elif column == 'grade':
+            if not value.isdigit() or not 1 <= int(value) <= 11:
+                raise ValueError(f"класс должен быть числом от 1 до 11, получено {value!r}")
+            value = int(value)
+        elif column == 'subject':
+            value = SUBJECTS.get(value, value)
+            if value not in SUBJECTS.values():
+                raise ValueError(f"неизвестный предмет {value!r}, допустимо: {', '.join(SUBJECTS)}")
+        elif column == 'first_name' and not value:
+            raise ValueError("не указано имя")
+        values.append(value)
+    return tuple(values)
+
+
+def import_csv(table, path, chunk_size=1000, progress=print):
+    columns = db.ROSTER_COLUMNS[table]
+    inserted = updated = errors = 0
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        missing = [column for column in columns if column not in (reader.fieldnames or ())]
+        if missing:
+            raise ValueError(f"в файле нет колонок: {', '.join(missing)}")
+
+        chunk = []
+        for record in reader:
+            try:
+                chunk.append(parse_row(table, record))
+            except ValueError as e:
+                errors += 1
+                progress(f"строка {reader.line_num}: {e}")
+                continue
+            if len(chunk) >= chunk_size:
+                added, changed = db.upsert_roster(table, chunk)
+                inserted, updated = inserted + added, updated + changed
+                progress(f"загружено строк: {inserted + updated}")
+                chunk = []
+        if chunk:
+            added, changed = db.upsert_roster(table, chunk)
+            inserted, updated = inserted + added, updated + changed
+    return inserted, updated, errors
+
+
+def export_csv(table, f, batch_size=1000):
+    writer = csv.writer(f)
+    writer.writerow(('id', 'user_id', 'username') + db.ROSTER_COLUMNS[table])
+    count = 0
+    for row in db.iter_roster(table, batch_size):
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Импорт и экспорт списков пользователей в CSV")
+    parser.add_argument("--db", help="путь к файлу базы (по умолчанию DB_PATH из .env)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import", help="загрузить CSV (обновление по номеру телефона и имени)")
+    import_parser.add_argument("table", choices=db.ROSTER_COLUMNS)
+    import_parser.add_argument("path")
+    import_parser.add_argument("--chunk-size", type=int, default=1000, help="число строк в одной транзакции")
+
+    export_parser = commands.add_parser("export", help="выгрузить таблицу в CSV")
+    export_parser.add_argument("table", choices=db.ROSTER_COLUMNS)
+    export_parser.add_argument("-o", "--output", help="файл (по умолчанию stdout)")
+
+    conflicts_parser = commands.add_parser("conflicts", help="вывести записи с общим номером телефона в CSV")
+    conflicts_parser.add_argument("table", choices=db.ROSTER_COLUMNS)
+    args = parser.parse_args()
+
+    load_dotenv()
+    if args.db:
+        db.configure_pool(path=args.db)
+    db.init_db()
+
+    if args.command == "import":
+        progress = partial(print, file=sys.stderr)
+        try:
+            inserted, updated, errors = import_csv(args.table, args.path, args.chunk_size, progress)
+        except ValueError as e:
+            sys.exit(f"Ошибка: {e}")
+        print(f"Добавлено: {inserted}, обновлено: {updated}, пропущено с ошибками: {errors}")
+    elif args.command == "conflicts":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(('id', 'user_id', 'username') + db.ROSTER_COLUMNS[args.table])
+        writer.writerows(db.get_phone_conflicts(args.table))
+    elif args.output:
+        with open(args.output, "w", newline='', encoding='utf-8') as f:
+            count = export_csv(args.table, f)
+        print(f"Выгружено строк: {count}", file=sys.stderr)
+    else:
+        export_csv(args.table, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
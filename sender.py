@@ -0,0 +1,155 @@
+import asyncio
+import itertools
+import logging
+import time
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import SendMessage
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_REPLY = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, now=None):
+        now = now or time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SendQueue:
+    def __init__(self, bot, workers=4, global_rate=30.0, chat_rate=1.0, group_rate=20 / 60,
+                 max_retries=5, base_backoff=1.0):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._global = TokenBucket(global_rate)
+        self._chats = {}
+        self._paused_until = 0.0
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while not self._queue.empty():
+            _, _, _, future, _ = self._queue.get_nowait()
+            future.cancel()
+
+    def submit(self, method, priority=PRIORITY_NORMAL):
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self._log_failure)
+        self._put(priority, method, future, 0)
+        return future
+
+    def send_message(self, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+        return self.submit(SendMessage(chat_id=chat_id, text=text, **kwargs), priority)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def set_global_rate(self, rate):
+        self._global = TokenBucket(rate)
+
+    def set_group_rate(self, rate):
+        self.group_rate = rate
+        self._chats = {k: v for k, v in self._chats.items() if not (isinstance(k, int) and k < 0)}
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Не удалось отправить сообщение: %s", future.exception())
+
+    def _put(self, priority, method, future, attempt):
+        self._queue.put_nowait((priority, next(self._seq), method, future, attempt))
+
+    def _put_later(self, delay, priority, method, future, attempt):
+        asyncio.get_running_loop().call_later(delay, self._put, priority, method, future, attempt)
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {k: v for k, v in self._chats.items() if not v.is_full(now)}
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, capacity=1)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            priority, _, method, future, attempt = await self._queue.get()
+            if future.done():
+                continue
+
+            now = time.monotonic()
+            chat_id = getattr(method, 'chat_id', None)
+            if chat_id is not None:
+                delay = self._chat_bucket(chat_id, now).try_acquire(now)
+                if delay:
+                    self._put_later(delay, priority, method, future, attempt)
+                    continue
+
+            while True:
+                now = time.monotonic()
+                delay = self._paused_until - now
+                if delay <= 0:
+                    delay = self._global.try_acquire(now)
+                    if not delay:
+                        break
+                await asyncio.sleep(delay)
+
+            try:
+                result = await self.bot(method)
+            except TelegramRetryAfter as e:
+                self.retried += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                logger.warning("Flood control, пауза %s с", e.retry_after)
+                self._put_later(e.retry_after, priority, method, future, attempt)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt >= self.max_retries:
+                    self.failed += 1
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    self.retried += 1
+                    self._put_later(self.base_backoff * 2 ** attempt, priority, method, future, attempt + 1)
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.sent += 1
+                if not future.done():
+                    future.set_result(result)
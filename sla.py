@@ -0,0 +1,104 @@
+import asyncio
+import heapq
+import logging
+import time
+
+import async_db
+
+logger = logging.getLogger(__name__)
+
+
+class SlaScheduler:
+    def __init__(self, on_expire, delays=(30 * 60, 2 * 60 * 60), batch_size=1000, retry_delay=60.0, owner=None):
+        self.on_expire = on_expire
+        self.owner = owner
+        self.delays = delays
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self.fired = 0
+        self._heap = []
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._handlers = set()
+
+    async def start(self, restore=True):
+        if restore:
+            await self.restore()
+        self._task = asyncio.create_task(self._run())
+
+    async def restore(self):
+        restored = 0
+        after_id = 0
+        while True:
+            tickets = await async_db.get_ticket_deadlines(after_id, len(self.delays), self.batch_size, self.owner)
+            if not tickets:
+                break
+            for ticket_id, created_at, stage in tickets:
+                if ticket_id not in self._pending:
+                    self.schedule(ticket_id, created_at, stage)
+                    restored += 1
+            after_id = tickets[-1][0]
+        if restored:
+            logger.info("Восстановлено сроков ответа на запросы: %d", restored)
+        return restored
+
+    async def stop(self):
+        tasks = list(self._handlers)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def schedule(self, ticket_id, created_at=None, stage=0):
+        if stage >= len(self.delays):
+            return
+        created_at = created_at or time.time()
+        self._push(ticket_id, created_at + self.delays[stage], stage, created_at)
+
+    def _push(self, ticket_id, deadline, stage, created_at):
+        self._pending[ticket_id] = (deadline, stage)
+        if len(self._heap) > 2 * len(self._pending) + 64:
+            self._heap = [entry for entry in self._heap if self._pending.get(entry[1]) == (entry[0], entry[2])]
+            heapq.heapify(self._heap)
+        if not self._heap or deadline < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (deadline, ticket_id, stage, created_at))
+
+    def cancel(self, ticket_id):
+        self._pending.pop(ticket_id, None)
+
+    def pending(self):
+        return len(self._pending)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, ticket_id, stage, created_at = heapq.heappop(self._heap)
+                if self._pending.get(ticket_id) != (deadline, stage):
+                    continue
+                del self._pending[ticket_id]
+                task = asyncio.create_task(self._fire(ticket_id, stage, created_at))
+                self._handlers.add(task)
+                task.add_done_callback(self._handlers.discard)
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, ticket_id, stage, created_at):
+        try:
+            if await self.on_expire(ticket_id, stage) is False:
+                return
+            self.fired += 1
+        except Exception:
+            logger.exception("Не удалось обработать просроченный запрос #%s", ticket_id)
+            self._push(ticket_id, time.time() + self.retry_delay, stage, created_at)
+            return
+        self.schedule(ticket_id, created_at, stage + 1)
@@ -0,0 +1,7 @@
+SUBJECTS = {
+    'russian': '📚 Русский язык',
+    'math': '📘 Математика',
+    'informatics': '🖥 Информатика',
+    'biology': '🍀 Биология',
+    'geography': '🌏 География'
+}
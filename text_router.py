@@ -0,0 +1,30 @@
+import inspect
+
+from aiogram import types
+from aiogram.filters import Filter
+
+
+class TextCommandRouter(Filter):
+    def __init__(self):
+        self.handlers = {}
+
+    def button(self, text):
+        def decorator(handler):
+            params = inspect.signature(handler).parameters
+            accepts_all = any(p.kind is inspect.Parameter.VAR_KEYWORD for p in params.values())
+            names = None if accepts_all else frozenset(list(params)[1:])
+            self.handlers[text] = (handler, names)
+            return handler
+        return decorator
+
+    async def __call__(self, message: types.Message):
+        entry = self.handlers.get(message.text)
+        if entry is None:
+            return False
+        return {'button_handler': entry}
+
+    async def dispatch(self, message: types.Message, button_handler, **kwargs):
+        handler, names = button_handler
+        if names is not None:
+            kwargs = {k: v for k, v in kwargs.items() if k in names}
+        return await handler(message, **kwargs)
@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+
+
+class RateLimiter:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.idle = burst / rate
+        self._buckets = OrderedDict()
+
+    def hit(self, key, now=None):
+        now = now or time.monotonic()
+        while self._buckets:
+            oldest = next(iter(self._buckets.values()))
+            if oldest[1] >= now - self.idle:
+                break
+            self._buckets.popitem(last=False)
+
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            tokens, warned = self.burst, False
+        else:
+            tokens, warned = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate), bucket[2]
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now, False)
+            return True, False
+        self._buckets[key] = (tokens, now, True)
+        return False, not warned
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def command_name(update):
+    message = update.message
+    if message is None:
+        return None
+    if message.contact is not None:
+        return 'contact'
+    text = message.text or ''
+    if text.startswith('/'):
+        return text[1:].split(maxsplit=1)[0].split('@')[0] if len(text) > 1 else None
+    return text
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, rate=2.0, burst=10, commands=None, notify=None):
+        self.user_limiter = RateLimiter(rate, burst)
+        self.command_limiters = {name: RateLimiter(*limit) for name, limit in (commands or {}).items()}
+        self.notify = notify
+        self.throttled = {}
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        rule = 'user'
+        allowed, first_refusal = self.user_limiter.hit(user.id, now)
+        if allowed:
+            name = command_name(event)
+            limiter = self.command_limiters.get(name)
+            if limiter is not None:
+                rule = name
+                allowed, first_refusal = limiter.hit(user.id, now)
+        if allowed:
+            return await handler(event, data)
+
+        self.throttled[rule] = self.throttled.get(rule, 0) + 1
+        if first_refusal and self.notify is not None:
+            await self.notify(event, rule)
+        return None
+
+    def tracked(self):
+        return len(self.user_limiter) + sum(map(len, self.command_limiters.values()))
+
+    def total_throttled(self):
+        return sum(self.throttled.values())
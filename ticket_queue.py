@@ -0,0 +1,152 @@
+import asyncio
+import logging
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+import async_db
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_ERRORS = (TelegramNetworkError, TelegramServerError, TelegramRetryAfter)
+
+
+class TicketQueue:
+    def __init__(self, post, retry_delay=5.0, batch_size=100, writes=async_db, max_attempts=5, fallback=None,
+                 owner=None, park_delay=600.0):
+        self.post = post
+        self.owner = owner
+        self.writes = writes
+        self.retry_delay = retry_delay
+        self.park_delay = park_delay
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.fallback = fallback
+        self.failed = 0
+        self._queue = asyncio.Queue()
+        self._retries = {}
+        self._parked = {}
+        self._worker = None
+
+    async def start(self, recover=True):
+        if recover:
+            await self.recover()
+        self._worker = asyncio.create_task(self._run())
+
+    async def recover(self):
+        after_id = 0
+        while True:
+            tickets = await async_db.get_unposted_tickets(after_id=after_id, limit=self.batch_size, owner=self.owner)
+            if not tickets:
+                break
+            for ticket in tickets:
+                if ticket['id'] not in self._retries and ticket['id'] not in self._parked:
+                    self._queue.put_nowait((ticket, 0))
+            after_id = tickets[-1]['id']
+        if self._queue.qsize():
+            logger.info("Восстановлено неотправленных запросов: %d", self._queue.qsize())
+
+    async def adopt(self, owner):
+        tickets = [ticket for ticket in await async_db.adopt_tickets(owner, self.owner) if ticket['posted_at'] is None]
+        for ticket in tickets:
+            self._queue.put_nowait((ticket, 0))
+        if tickets:
+            logger.info("Приняты неотправленные запросы воркера %s: %d", owner, len(tickets))
+        return len(tickets)
+
+    async def stop(self):
+        for handle in (*self._retries.values(), *self._parked.values()):
+            handle.cancel()
+        self._retries.clear()
+        self._parked.clear()
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def submit(self, user_id, subject, text, grade=None, media=None):
+        ticket = await self.writes.add_ticket(user_id, subject, text, grade, media, self.owner)
+        self._queue.put_nowait((ticket, 0))
+        return ticket
+
+    def pending(self):
+        return self._queue.qsize() + len(self._retries)
+
+    def parked(self):
+        return len(self._parked)
+
+    async def drain(self, timeout):
+        try:
+            await asyncio.wait_for(self._idle(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не успели отправить запросов: %d", self.pending())
+
+    async def _idle(self):
+        while True:
+            await self._queue.join()
+            if not self._retries:
+                return
+            await asyncio.sleep(0.1)
+
+    def _retry_later(self, ticket, attempt):
+        self._retries[ticket['id']] = asyncio.get_running_loop().call_later(
+            self.retry_delay * 2 ** (attempt - 1), self._requeue, ticket, attempt
+        )
+
+    def _requeue(self, ticket, attempt):
+        self._retries.pop(ticket['id'], None)
+        self._queue.put_nowait((ticket, attempt))
+
+    def _park(self, ticket):
+        self._parked[ticket['id']] = asyncio.get_running_loop().call_later(self.park_delay, self._unpark, ticket)
+
+    def _unpark(self, ticket):
+        self._parked.pop(ticket['id'], None)
+        self._queue.put_nowait((ticket, 0))
+
+    async def _run(self):
+        while True:
+            ticket, attempt = await self._queue.get()
+            try:
+                await self._post(ticket, attempt)
+            except Exception:
+                logger.exception("Не удалось сохранить результат отправки запроса #%s", ticket['id'])
+                if attempt + 1 < self.max_attempts:
+                    self._retry_later(ticket, attempt + 1)
+            finally:
+                self._queue.task_done()
+
+    async def _post(self, ticket, attempt):
+        try:
+            sent = await self.post(ticket)
+        except RETRYABLE_ERRORS as e:
+            if attempt + 1 < self.max_attempts:
+                logger.warning("Не удалось отправить запрос #%s (попытка %d): %s", ticket['id'], attempt + 1, e)
+                self._retry_later(ticket, attempt + 1)
+                return
+            error = e
+        except Exception as e:
+            error = e
+        else:
+            return await self._mark_posted(ticket, sent)
+
+        self.failed += 1
+        logger.error("Запрос #%s не отправлен экспертам: %s", ticket['id'], error)
+        if self.fallback is not None:
+            try:
+                sent = await self.fallback(ticket)
+            except Exception:
+                logger.exception("Не удалось отправить запрос #%s в резервный чат", ticket['id'])
+            else:
+                if sent is not None:
+                    return await self._mark_posted(ticket, sent)
+        logger.error("Запрос #%s отложен, повторная отправка через %.0f с", ticket['id'], self.park_delay)
+        self._park(ticket)
+
+    async def _mark_posted(self, ticket, sent):
+        if sent is not None:
+            await async_db.mark_ticket_posted(ticket['id'], sent.chat.id, sent.message_id)
+        else:
+            await async_db.mark_ticket_posted(ticket['id'])
@@ -0,0 +1,91 @@
+import asyncio
+import hmac
+import logging
+
+from aiogram import types
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    def __init__(self, dp, bot, path="/webhook", secret=None, queue_size=1000, workers=4):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.workers = workers
+        self.received = 0
+        self.rejected = 0
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    def authorized(self, request):
+        return not self.secret or hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret)
+
+    async def handle(self, request):
+        if not self.authorized(request):
+            self.rejected += 1
+            return web.Response(status=403)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError:
+            self.rejected += 1
+            return web.Response(status=400)
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return web.Response(status=503)
+        self.received += 1
+        return web.Response()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    async def _on_startup(self, app):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _on_cleanup(self, app):
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception:
+                logger.exception("Ошибка обработки обновления %s", update.update_id)
+            finally:
+                self._queue.task_done()
+
+
+async def run_webhook(dp, bot, url=None, path="/webhook", host="0.0.0.0", port=8080, secret=None,
+                      queue_size=1000, workers=4):
+    if not secret:
+        raise ValueError("WEBHOOK_SECRET не задан: без него любой может отправлять боту поддельные обновления")
+    server = WebhookServer(dp, bot, path=path, secret=secret, queue_size=queue_size, workers=workers)
+    runner = web.AppRunner(server.create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info("Webhook слушает http://%s:%s%s", host, port, path)
+    if url:
+        await bot.set_webhook(url.rstrip("/") + path, secret_token=secret)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,68 @@
+import asyncio
+import functools
+
+import async_db
+import db
+
+
+class WriteBatcher:
+    def __init__(self, max_delay=0.005, max_batch=200):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.batches = 0
+        self.rows = 0
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    def __getattr__(self, name):
+        if name not in db.BATCHED_INSERTS:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        return functools.partial(self.submit, name)
+
+    def submit(self, name, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((name, args, kwargs, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush_pending()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush_pending)
+        return future
+
+    def pending(self):
+        return len(self._pending)
+
+    async def flush(self):
+        self._flush_pending()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def close(self):
+        await self.flush()
+
+    def _flush_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._write(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, batch):
+        try:
+            results = await async_db.write_batch([(name, args, kwargs) for name, args, kwargs, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        else:
+            self.batches += 1
+            self.rows += len(batch)
+        for (_, _, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)